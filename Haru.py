@@ -1,11 +1,16 @@
 from __future__ import print_function
 import time
 import datetime
-import shutil
+import functools
+import utility
+import distributed
+import evaluator
 
 from model import *
-from collections import OrderedDict
-from data.networks import GANLoss
+from data.networks import GANLoss, PerceptualLoss
+from data.cache import build_image_cache
+from data.packed import PackedRainHazeDataset
+from data.augment import build_batch_augment
 from skimage.transform import resize
 
 # torch
@@ -18,7 +23,7 @@ from torchvision import transforms
 from torch.utils.data import DataLoader
 from tensorboard_logger import configure
 
-from loader import HaruLoader
+from loader import HaruLoader, loader_kwargs
 from trainer import HaruTrainer
 
 
@@ -64,7 +69,11 @@ class Haru(object):
             self.data = torch.utils.data.dataset()
         else:
             # 自定义
-            self.data = HaruLoader('train', args=None)
+            self.data = HaruLoader('train', args=config)
+        # 解码后图像的缓存, 见 data/cache.py
+        self.image_cache = build_image_cache(config)
+        # 批量数据增强, 见 data/augment.py
+        self.batch_augment = build_batch_augment(config)
         # 训练：训练+测试，只测试
         # 训练类：包括测试
         self.trainer = HaruTrainer(data=self.data(), my_model=None, my_loss=None, ckp=None)
@@ -80,20 +89,47 @@ class Haru(object):
     #     self.trainer.test()
 
     def create_model(self):
+        # 训练设备与精度: train: device / precision / channels_last
+        train_cfg = self.config.get('train') or {}
+        gpuid = self.gpuid
+        if distributed.is_distributed() and torch.cuda.is_available():
+            gpuid = distributed.get_rank() % torch.cuda.device_count()
+        self.device = torch.device(train_cfg.get('device') or
+                                   ('cuda:%d' % gpuid if torch.cuda.is_available() else 'cpu'))
+        self.precision = train_cfg.get('precision') or 'fp32'
+        self.channels_last = bool(train_cfg.get('channels_last'))
+        # gradient accumulation: one optimizer step every accumulation_steps micro-batches
+        self.accumulation_steps = max(1, int(train_cfg.get('accumulation_steps') or 1))
+        # torch.compile of the stage 1 step, see HaruTrainer.build_stage1_step
+        self.compile_cfg = train_cfg.get('compile') or {}
+        self.scaler = utility.make_grad_scaler(self.device, self.precision)
+        memory_format = torch.channels_last if self.channels_last else torch.contiguous_format
         # == define perceptual model==
-        self.vgg_model = torchvision.models.vgg16(pretrained=True).cuda(self.gpuid)
+        # only the VGG16 layers up to the perceptual layer of the stage are kept (Haru.vgg(img, l))
+        vgg_layer = 8 if self.mode == 'train' and self.training_stage == 2 else 3
+        self.perceptual_loss = PerceptualLoss(torchvision.models.vgg16(pretrained=True), vgg_layer - 1)
+        self.perceptual_loss.to(self.device, memory_format=memory_format)
+        self.vgg_model = self.perceptual_loss.features
         # == simple rain feature extractors ==
-        self.G = DecompModel().cuda(self.gpuid)
+        self.G = DecompModel().to(self.device, memory_format=memory_format)
         self.G_optim = torch.optim.Adam(self.G.parameters(), lr=self.LR, betas=(0.9, 0.999))
         if self.mode == 'train' and self.training_stage == 2:
-            self.D = DepthGuidedD(self.ch_in).cuda(self.gpuid)
+            self.D = DepthGuidedD(self.ch_in).to(self.device, memory_format=memory_format)
             self.D_optim = torch.optim.Adam(self.D.parameters(), lr=self.LR * 0.1, betas=(0.9, 0.999))
         # == Multiple GPUs ==
-        if self.parallel:
+        # 多进程训练时由 wrap_distributed 包装成 DistributedDataParallel
+        if self.parallel and not distributed.is_distributed():
             self.G = torch.nn.DataParallel(self.G)
             if self.D:
                 self.D = torch.nn.DataParallel(self.D)
 
+    def wrap_distributed(self):
+        # DistributedDataParallel once the trainable parameters are settled (see set_gradients)
+        self.G = distributed.wrap_model(self.G, self.device)
+        if getattr(self, 'D', None) is not None:
+            # conv9 of DepthGuidedD is left out of its forward
+            self.D = distributed.wrap_model(self.D, self.device, find_unused_parameters=True)
+
     def init_weights(self, m):
         if type(m) == nn.Conv2d or type(m) == nn.Linear:
             torch.nn.init.xavier_uniform(m.weight)
@@ -101,86 +137,113 @@ class Haru(object):
 
     def reset(self, config):
         # tensorboard set up
-        if self.use_tensorboard and self.mode == 'train':
+        # only rank 0 writes logs when training with several processes
+        tensorboard = self.use_tensorboard and self.mode == 'train' and distributed.is_main_process()
+        if tensorboard:
             tensorboard_dir = self.logs_dir + self.model_name
             print('[*] Saving tensorboard logs to {}'.format(tensorboard_dir))
             if not os.path.exists(tensorboard_dir):
                 os.makedirs(tensorboard_dir)
             configure(tensorboard_dir)
+        # training scalars are buffered and written by a background thread (tensorboard/jsonl/csv)
+        self.metrics = utility.build_metrics_logger(config, self.logs_dir + self.model_name, tensorboard,
+                                                    main_process=distributed.is_main_process())
+        # per-phase step timing and torch.profiler trace, `profile:` in application.yml
+        self.profiler = utility.build_step_profiler(config, self.device)
+        # checkpoints are snapshotted to the CPU and written by a background thread, `checkpoint:` in application.yml
+        self.checkpoints = utility.build_checkpoint_writer(config, self.ckpt_dir, self.model_name)
+        # training previews are encoded and saved on a background thread
+        self.preview = utility.build_preview_writer(config)
         # disable vgg update
         for para in self.vgg_model.parameters():
             para.requires_grad = False
 
     def set_gradients(self, trainable):
-        if self.parallel:
-            for param in self.G.module.fognet.parameters():
-                param.requires_grad = trainable
-            for param in self.G.module.rainnet.parameters():
-                param.requires_grad = trainable
-        else:
-            for param in self.G.fognet.parameters():
-                param.requires_grad = trainable
-            for param in self.G.rainnet.parameters():
-                param.requires_grad = trainable
+        G = distributed.unwrap_model(self.G)
+        for param in G.fognet.parameters():
+            param.requires_grad = trainable
+        for param in G.rainnet.parameters():
+            param.requires_grad = trainable
 
     @staticmethod
     def trainable(model, trainable):
         for parameter in model.parameters():
             parameter.requires_grad = trainable
 
-    def write_image_stage1(self, path):
-        # tensor_zero = torch.zeros(self.batch_size, 3, self.image_size, self.image_size)
-        im_in = self.input_list[0]
-        recons = (im_in - (1 - self.trans_out.cpu()) * self.atm_out.cpu()) / (
-                self.trans_out.cpu() + 0.0001) - self.st_out.cpu()
-        input_row = torch.cat(self.input_list[0:-1], dim=3)
-        output_row = torch.cat(
-            (recons, self.st_out.cpu(), self.trans_out.cpu(), self.atm_out.cpu(), self.clean_out.cpu()), dim=3)
+    def write_image_stage1(self, path, block=False):
+        if not distributed.is_main_process():
+            return
+        # painter of the first sample, built on the device and written by self.preview
+        inputs = [t[:1].to(self.device, non_blocking=True) for t in self.input_list[0:-1]]
+        st_out, trans_out, atm_out, clean_out = [t[:1].detach() for t in
+                                                 (self.st_out, self.trans_out, self.atm_out, self.clean_out)]
+        recons = (inputs[0] - (1 - trans_out) * atm_out) / (trans_out + 0.0001) - st_out
+        input_row = torch.cat(inputs, dim=3)
+        output_row = torch.cat((recons, st_out, trans_out, atm_out, clean_out), dim=3)
         painter = torch.cat((input_row, output_row), dim=2)
-        img = tensor_to_image(painter)
-        img = np.clip(img * 255, 0, 255)
-        painter_image = Image.fromarray(img.astype(np.uint8))
-        painter_image.save(path)
-
-    def write_image_stage2(self, path):
-        tensor_zero = torch.zeros(self.batch_size, 3, self.image_size, self.image_size)
-        im_in = self.input_list[0]
-        im_real_in = self.input_list[-1]
-        recons = (im_in - (1 - self.trans_out.cpu()) * self.atm_out.cpu()) / (
-                self.trans_out.cpu() + 0.0001) - self.st_out.cpu()  # - self.st_out.cpu()
-        input_row = torch.cat(self.input_list[:-1], dim=3)
-        output_row = torch.cat(
-            (recons, self.st_out.cpu(), self.trans_out.cpu(), self.atm_out.cpu(), self.clean_out.cpu()), dim=3)
-        realrecons = (im_real_in - (1 - self.realrain_trans.cpu()) * self.realrain_atm.cpu()) / \
-                     (self.realrain_trans.cpu() + 0.0001) - self.realrain_st.cpu()
-        real_row = torch.cat((im_real_in, realrecons, self.realrain_trans.cpu(), self.realrain_atm.cpu(),
-                              self.realrain_out.cpu()), dim=3)
+        self.preview.submit(painter, path, block=block)
+
+    def write_image_stage2(self, path, block=False):
+        if not distributed.is_main_process():
+            return
+        inputs = [t[:1].to(self.device, non_blocking=True) for t in self.input_list]
+        im_in = inputs[0]
+        im_real_in = inputs[-1]
+        st_out, trans_out, atm_out, clean_out = [t[:1].detach() for t in
+                                                 (self.st_out, self.trans_out, self.atm_out, self.clean_out)]
+        realrain_st, realrain_trans, realrain_atm, realrain_out = [
+            t[:1].detach() for t in (self.realrain_st, self.realrain_trans, self.realrain_atm, self.realrain_out)]
+        recons = (im_in - (1 - trans_out) * atm_out) / (trans_out + 0.0001) - st_out  # - self.st_out.cpu()
+        input_row = torch.cat(inputs[:-1], dim=3)
+        output_row = torch.cat((recons, st_out, trans_out, atm_out, clean_out), dim=3)
+        realrecons = (im_real_in - (1 - realrain_trans) * realrain_atm) / \
+                     (realrain_trans + 0.0001) - realrain_st
+        real_row = torch.cat((im_real_in, realrecons, realrain_trans, realrain_atm, realrain_out), dim=3)
         painter = torch.cat((input_row, output_row, real_row), dim=2)
-        img = tensor_to_image(painter)
-        img = np.clip(img * 255, 0, 255)
-        painter_image = Image.fromarray(img.astype(np.uint8))
-        painter_image.save(path)
+        self.preview.submit(painter, path, block=block)
 
     def load_data(self, mode, aug=False):
+        packed = (self.config.get('data') or {}).get('packed')
         if mode == 'train':
-            dataset = RainHazeImageDataset(self.train_dir, 'train',
-                                           aug=aug,
-                                           transform=transforms.Compose([ToTensor()]))
+            # with batch_augment the datasets return uint8 crops, see data/augment.py
+            if packed:
+                dataset = PackedRainHazeDataset(self.train_dir, 'train',
+                                                aug=aug,
+                                                transform=transforms.Compose([ToTensor()]),
+                                                batch_augment=self.batch_augment is not None)
+            else:
+                dataset = RainHazeImageDataset(self.train_dir, 'train',
+                                               aug=aug,
+                                               transform=transforms.Compose([ToTensor()]),
+                                               cache=self.image_cache,
+                                               batch_augment=self.batch_augment is not None)
             shuff = True
         elif mode == 'val':
-            dataset = RainHazeImageDataset(self.val_dir, 'val',
-                                           transform=transforms.Compose([ToTensor()]))
+            if packed:
+                dataset = PackedRainHazeDataset(self.val_dir, 'val',
+                                                transform=transforms.Compose([ToTensor()]))
+            else:
+                dataset = RainHazeImageDataset(self.val_dir, 'val',
+                                               transform=transforms.Compose([ToTensor()]),
+                                               cache=self.image_cache)
             shuff = False
         else:
             dataset = None
             shuff = False
             print('Undefined mode', mode)
             exit()
+        # stage 2 rebuilds the loader every epoch, the epoch moves the seeded shuffle / augmentation on
+        kwargs = loader_kwargs(self.config, self.batch_size, getattr(self, 'epoch', 0))
+        if mode == 'train' and self.batch_augment is not None and not self.batch_augment.on_device:
+            kwargs['collate_fn'] = functools.partial(self.batch_augment.collate, aug=aug)
+        # 多进程训练时每个进程只读自己的分片
+        sampler = distributed.distributed_sampler(dataset, shuff)
         data_loader = DataLoader(dataset,
-                                 batch_size=self.batch_size,
-                                 shuffle=shuff,
+                                 shuffle=shuff and sampler is None,
+                                 sampler=sampler,
                                  drop_last=True,
-                                 num_workers=self.batch_size)
+                                 **kwargs)
+        distributed.set_epoch(data_loader, getattr(self, 'epoch', 0))
         return data_loader
 
     def save_checkpoint(self, state, msg, is_best):
@@ -190,19 +253,13 @@ class Haru(object):
         on the test data.
 
         If this model has reached the best validation accuracy thus
-        far, a seperate file with the suffix `best` is created.
+        far, the alias with the suffix `best` is linked to it, `last` always is.
+        The file is written in the background, see utility.CheckpointWriter.
+        Only rank 0 writes when training with several processes.
         """
-        filename = self.model_name + msg + '_ckpt.pth.tar'
-        if not os.path.exists(self.ckpt_dir):
-            os.mkdir(self.ckpt_dir)
-        ckpt_path = os.path.join(self.ckpt_dir, filename)
-        torch.save(state, ckpt_path)
-
-        if is_best:
-            filename = self.model_name + '_model_best.pth.tar'
-            shutil.copyfile(
-                ckpt_path, os.path.join(self.ckpt_dir, filename)
-            )
+        if not distributed.is_main_process():
+            return
+        self.checkpoints.save(state, msg, is_best)
 
     def load_checkpoint(self, msg, parallel, best=False, load_lr=True):
         print("[*] Loading model from {}{}.pth.tar".format(self.ckpt_dir, msg))
@@ -210,38 +267,19 @@ class Haru(object):
         if best:
             filename = self.model_name + '_model_best.pth.tar'
         ckpt_path = os.path.join(self.ckpt_dir, filename)
-        ckpt = torch.load(ckpt_path)
-        new_state_dict = OrderedDict()
-
-        if 'G' in ckpt.keys():
-            pretrained_weights = ckpt['G']
-        else:
-            pretrained_weights = ckpt
-        if parallel:  # expect module in the pretrained weights
-            for k, v, in pretrained_weights.items():
-                if 'module' not in k:
-                    name = 'module.' + k
-                    new_state_dict[name] = v
-                else:
-                    new_state_dict = pretrained_weights
-        else:
-            for k, v in pretrained_weights.items():
-                if 'module' in k:
-                    name = k[7:]
-                    new_state_dict[name] = v
-                else:
-                    new_state_dict = pretrained_weights
-        self.G.load_state_dict(new_state_dict)
+        # memory-mapped, D is never paged in; the state dict is keyed for the bare model (parallel is unused)
+        ckpt = utility.read_checkpoint(ckpt_path, ('G', 'lr', 'epoch', 'best_valid_acc'))
+        distributed.unwrap_model(self.G).load_state_dict(ckpt['G'])
         # self.D.load_state_dict(ckpt['D'])
         if load_lr:
             self.LR = ckpt['lr']
-        if 'epoch' in ckpt.keys():
+        if 'epoch' in ckpt:
             self.epoch = ckpt['epoch']
-        if 'best_valid_acc' in ckpt.keys():
+        if 'best_valid_acc' in ckpt:
             self.best_valid_acc = ckpt['best_valid_acc']
 
     def load_my_state_dict(self, state_dict):
-        own_state = self.G.state_dict()
+        own_state = distributed.unwrap_model(self.G).state_dict()
         for name, param in state_dict.items():
             if name not in own_state:
                 continue
@@ -256,15 +294,10 @@ class Haru(object):
         if best:
             filename = self.model_name + '_model_best.pth.tar'
         ckpt_path = os.path.join(self.ckpt_dir, filename)
-        ckpt = torch.load(ckpt_path)
+        ckpt = utility.read_checkpoint(ckpt_path, ('G', 'lr', 'epoch', 'best_valid_acc'))
 
-        state_dict = ckpt['G']
-        new_state_dict = OrderedDict()
-        for k, v in state_dict.items():
-            name = k[7:]
-            new_state_dict[name] = v
         # self.D.load_state_dict(ckpt['D'])
-        self.G.load_state_dict(new_state_dict)
+        distributed.unwrap_model(self.G).load_state_dict(ckpt['G'])
         # Gweights = ckpt['G']
         # mydict = self.G.state_dict()
         # for name, param in Gweights.items():
@@ -280,48 +313,54 @@ class Haru(object):
         self.best_valid_acc = ckpt['best_valid_acc']
 
     def validate(self):
-        start = time.time()
+        """
+        Validate the epoch with self.evaluator (see evaluator.py), on rank 0 only.
+        In the foreground self.is_best tells whether the checkpoint of the epoch is the best one;
+        with eval: background the result arrives during the next epoch and the best alias is
+        linked to the checkpoint of its epoch then (see finish_validation).
+        """
+        self.is_best = False
+        if not distributed.is_main_process():
+            return
         print("Validation: ", datetime.datetime.now())
-        total_loss = 0
-        sum_acc = 0
-        count = 0
-        dataloader = self.load_data('val', aug=False)
-        val_dir = 'val/' + str(self.epoch) + '/'
-        if not os.path.exists(val_dir):
-            os.makedirs(val_dir)
-        with torch.no_grad():
-            for i, self.input_list in enumerate(dataloader):
-                print('\rCount Number:%d,' % i, end=' ')
-                image_in_var = Variable(self.input_list[0]).cuda(self.gpuid)
-                streak_gt_var = Variable(self.input_list[1]).cuda(self.gpuid)
-                self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(image_in_var)
-                self.clean_out = (image_in_var - self.st_out - (1 - self.trans_out) * self.atm_out) / (
-                        self.trans_out + 0.0001)
-                sum_acc += compute_psnr(self.st_out, streak_gt_var)
-                if i % 100 == 0:
-                    self.write_image_stage1(val_dir + str(i) + '.png')
-                count = i
-            avg_acc = sum_acc / count
-        print("Epoch: {:02d} - Average loss: {:.3f} - Accuracy: {:.3f} Time: {}\n".format(
-            self.epoch, total_loss, avg_acc, time.time() - start))
-        state = {'epoch': self.epoch, 'G': self.G.state_dict(),
-                 'best_valid_acc': self.best_valid_acc, 'lr': self.LR}
-        if avg_acc > self.best_valid_acc:
-            self.best_valid_acc = avg_acc
-            self.save_checkpoint(state, 'last', True)
+        if getattr(self, 'evaluator', None) is None:
+            self.evaluator = evaluator.build_evaluator(self.config, self.val_dir, self.test_input_dir,
+                                                       self.image_size, self.batch_size,
+                                                       device=self.device, cache=self.image_cache)
+        # the evaluation of the previous epoch has had a whole epoch to finish
+        self.finish_validation(close=False)
+        result = self.evaluator.submit(distributed.unwrap_model(self.G), self.epoch)
+        if result is not None:
+            self.is_best = self.record_validation(result)
+
+    def record_validation(self, result):
+        print("Epoch: {:02d} - Accuracy: {:.3f} SSIM: {:.4f} Time: {:.1f}\n".format(
+            result['epoch'], result['psnr'], result['ssim'], result['time']))
+        if result['psnr'] > self.best_valid_acc:
+            self.best_valid_acc = result['psnr']
+            return True
+        return False
+
+    def finish_validation(self, close=True):
+        # collect the results of the evaluation process, the best one gets the best alias
+        if getattr(self, 'evaluator', None) is None:
+            return
+        for result in self.evaluator.results(block=True):
+            if self.record_validation(result):
+                self.checkpoints.link_best('-' + str(result['epoch']))
+        if close:
+            self.evaluator.close()
 
     def vgg(self, img, l):
-        x = img
-        for idx, layer in enumerate(self.vgg_model.modules()):
-            if 2 <= idx <= l:
-                x = layer(x)
-        return x
+        # features of the l-th module of VGG16's module walk (l >= 2), see PerceptualLoss
+        assert 2 <= l <= len(self.vgg_model) + 1
+        return self.vgg_model[:l - 1](img)
 
     def test(self):
         start = time.time()
         print("Testing: ", datetime.datetime.now())
         self.load_checkpoint('pretrained', best=False)
-        self.G.cuda()
+        self.G.to(self.device)
         self.G = torch.optim.Adam(self.G.parameters(), lr=self.LR)
         self.batch_size = 1
         sum_acc = 0
@@ -334,19 +373,29 @@ class Haru(object):
         with torch.no_grad():
             for i, self.input_list in enumerate(dataloader):
                 print('\rCount Number:%d,' % i, end=' ')
-                image_in_var = Variable(self.input_list[0]).cuda()
-                clean_gt_var = Variable(self.input_list[4]).cuda()
+                image_in_var = Variable(self.input_list[0]).to(self.device)
+                clean_gt_var = Variable(self.input_list[4]).to(self.device)
                 self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(image_in_var)
                 self.clean_out = (image_in_var - self.st_out - (1 - self.trans_out) * self.atm_out) / (
                         self.trans_out + 0.001)
-                self.write_image_stage1(val_dir + str(i) + '.jpg')
+                self.write_image_stage1(val_dir + str(i) + '.jpg', block=True)
                 sum_acc += compute_psnr(self.clean_out, clean_gt_var)
                 if i == 1000:
                     break
             avg_acc = sum_acc / 1000
         print("Average accuracy: ", avg_acc)
 
-    def predict_resize(self, iter='test'):
+    def predict_resize(self, iter='test', tile=None):
+        """
+        Run the real rain images of test_input_dir.
+        :param tile: tile size of DecompModel.forward_tiled; when set (or test: tile_size:
+                     in application.yml) images are processed at full resolution
+                     instead of being resized to image_size
+        """
+        if tile is None:
+            tile = (self.config.get('test') or {}).get('tile_size')
+        if tile:
+            return self.predict_tiled(iter, tile)
         print("Testing real rain images from: ", self.test_input_dir)
         if iter == 'test':
             self.load_checkpoint('pretrained2', False)
@@ -364,7 +413,7 @@ class Haru(object):
                 rain_image = read_image(filename, noise=False)
                 rain_image = resize(rain_image, [self.image_size, self.image_size])
                 self.image_in[0, :, :, :] = torch.from_numpy(rain_image.transpose(2, 0, 1))
-                input_var = Variable(self.image_in).cuda(self.gpuid)
+                input_var = Variable(self.image_in).to(self.device)
                 self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(input_var)
                 recons = (input_var - (1 - self.trans_out) * self.atm_out) / (self.trans_out + 0.0001) - self.st_out
                 painter1 = torch.cat([input_var, self.st_out, self.trans_out], dim=3)
@@ -372,3 +421,37 @@ class Haru(object):
                 painter = torch.cat([painter1, painter2], dim=2)
                 write_tensor(painter, outdir + self.file_list[i])
         print('\n')
+
+    def predict_tiled(self, iter='test', tile=512):
+        print("Testing real rain images at full resolution from: ", self.test_input_dir)
+        if iter == 'test':
+            self.load_checkpoint('pretrained2', False)
+        G = distributed.unwrap_model(self.G)
+        device = next(G.parameters()).device
+        # also called from training (train_stage2): predict_atm batches up to 64 tiles through
+        # the atmnet BatchNorms, which must use and keep the running statistics
+        training = G.training
+        G.eval()
+        cfg = self.config.get('test') or {}
+        self.file_list = os.listdir(self.test_input_dir)
+        self.file_list.sort()
+        outdir = 'out/' + iter + '/'
+        if not os.path.exists(outdir):
+            os.makedirs(outdir)
+        with torch.no_grad():
+            for i, name in enumerate(self.file_list):
+                filename = os.path.join(self.test_input_dir, name)
+                print('\rTesting  %d image name:,' % i, filename, end=' ')
+                rain_image = read_image(filename, noise=False)
+                input_var = torch.from_numpy(rain_image.transpose(2, 0, 1)).unsqueeze(0).to(device)
+                A = G.predict_atm(input_var)
+                self.st_out, self.trans_out, self.atm_out, self.clean_out = G.forward_test(
+                    input_var, A, mode='run', tile=tile,
+                    overlap=cfg.get('tile_overlap', 64), tile_batch=cfg.get('tile_batch', 4))
+                recons = (input_var - (1 - self.trans_out) * self.atm_out) / (self.trans_out + 0.0001) - self.st_out
+                painter1 = torch.cat([input_var, self.st_out, self.trans_out], dim=3)
+                painter2 = torch.cat([recons, self.clean_out, self.atm_out], dim=3)
+                painter = torch.cat([painter1, painter2], dim=2)
+                write_tensor(painter, outdir + name)
+        G.train(training)
+        print('\n')
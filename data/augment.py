@@ -0,0 +1,121 @@
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+class BatchAugment(object):
+    """
+    Vectorized augment() for collated batches.
+
+    Works on the list of B x C x H x W tensors a DataLoader yields for
+    RainHazeImageDataset (uint8 or float) and applies RandomCrop,
+    RandomHorizontalFlip and RandomColorWarp as whole-batch tensor ops. Every
+    sample draws its own parameters, shared by its components like augment()
+    does; the last component (real rain) gets its own crop window as in
+    RandomCrop. uint8 input is converted to float in [0,1] after the crop,
+    with the noise of read_image on the rain input: the datasets built with
+    batch_augment return uint8 crops and leave all of this to the batch.
+    """
+
+    def __init__(self, crop_size=224, hflip=True, color_warp=True, std_range=0.05, mean_range=0.0,
+                 noise=True, device='cpu'):
+        """
+        :param crop_size: output size, None keeps the collated size
+        :param hflip: random horizontal flip with probability 0.5
+        :param color_warp: random per-channel gain/offset and channel permutation
+        :param noise: gaussian noise on the rain input (first component) of uint8 batches, as read_image
+        :param device: 'cpu' to run as collate_fn in the DataLoader workers,
+                       'device' to run on the training device after the host-to-device copy
+        """
+        self.crop_size = crop_size
+        self.hflip = hflip
+        self.color_warp = color_warp
+        self.noise = noise
+        self.std_range = std_range
+        self.mean_range = mean_range
+        self.device = device
+
+    @property
+    def on_device(self):
+        return self.device == 'device'
+
+    def collate(self, batch, aug=True):
+        return self(default_collate(batch), aug)
+
+    def __call__(self, input_list, aug=True):
+        """
+        :param input_list: collated B x C x H x W components, the real rain image last
+        :param aug: the aug of the dataset, without it the batch is only converted to float (no crop,
+                    flip or colour warp), like the datasets do for aug=False
+        """
+        b, c, h, w = input_list[0].size()
+        device = input_list[0].device
+        crop = aug and self.crop_size and (h, w) != (self.crop_size, self.crop_size)
+        hflip = aug and self.hflip
+        color_warp = aug and self.color_warp
+        if crop:
+            rows, cols = self.random_offsets(b, h, w, device)
+            rh, rw = input_list[-1].size()[2:]
+            real_rows, real_cols = self.random_offsets(b, rh, rw, device)
+        if hflip:
+            flip = (torch.rand(b) < 0.5).view(b, 1, 1, 1).to(device)
+        if color_warp:
+            gain = 1 + torch.empty(b, c, 1, 1).uniform_(-self.std_range, self.std_range).to(device)
+            offset = torch.empty(b, c, 1, 1).uniform_(-self.mean_range, self.mean_range).to(device)
+            order = torch.argsort(torch.rand(b, c), dim=1).view(b, c, 1, 1).to(device)
+
+        output_list = []
+        for k, x in enumerate(input_list):
+            if crop:
+                if k == len(input_list) - 1:
+                    x = self.crop(x, real_rows, real_cols)
+                else:
+                    x = self.crop(x, rows, cols)
+            if x.dtype == torch.uint8:
+                x = self.to_float(x, self.noise and k == 0)
+            if hflip:
+                x = torch.where(flip, x.flip(3), x)
+            if color_warp:
+                x = x * gain + offset
+                x = torch.gather(x, 1, order.expand_as(x))
+            output_list.append(x)
+        return output_list
+
+    @staticmethod
+    def to_float(x, noise):
+        # image_to_float on the batch: N(0, 1) on the [0, 255] values, shared by the channels
+        x = x.float()
+        if noise:
+            b, _, h, w = x.size()
+            x += torch.randn(b, 1, h, w, device=x.device)
+        return x.div_(255.0).clamp_(0, 1)
+
+    def random_offsets(self, b, h, w, device):
+        # same range as np.random.randint(h - size) in RandomCrop
+        rows = torch.randint(0, h - self.crop_size, (b,)).to(device)
+        cols = torch.randint(0, w - self.crop_size, (b,)).to(device)
+        return rows, cols
+
+    def crop(self, x, rows, cols):
+        # gathers a different window per sample in one indexing op
+        b = x.size(0)
+        steps = torch.arange(self.crop_size, device=x.device)
+        row_idx = (rows.view(b, 1) + steps).view(b, -1, 1)
+        col_idx = (cols.view(b, 1) + steps).view(b, 1, -1)
+        batch_idx = torch.arange(b, device=x.device).view(b, 1, 1)
+        x = x.permute(0, 2, 3, 1)[batch_idx, row_idx, col_idx]
+        return x.permute(0, 3, 1, 2).contiguous()
+
+
+def build_batch_augment(config):
+    """
+    Build the BatchAugment described by `train: batch_augment:` of application.yml
+    :return: BatchAugment, or None when batched augmentation is off
+    """
+    cfg = ((config or {}).get('train') or {}).get('batch_augment')
+    if not cfg or not cfg.get('device'):
+        return None
+    return BatchAugment(crop_size=cfg.get('crop_size', 224),
+                        hflip=cfg.get('hflip', True),
+                        color_warp=cfg.get('color_warp', True),
+                        noise=cfg.get('noise', True),
+                        device=cfg['device'])
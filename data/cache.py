@@ -0,0 +1,166 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from PIL import Image
+
+
+class ImageCache(object):
+    """
+    Decoded-image cache consulted by read_image before touching PIL.
+
+    Decoded images are kept as they come out of PIL (uint8 H x W x C for 8-bit
+    files) so the cache holds 4x less than the float32 arrays read_image returns.
+    The in-process part is an LRU bounded by max_bytes, per process: every
+    DataLoader worker, the main process and every distributed rank hold their
+    own LRU, so the total is up to max_bytes x (num_workers + 1) x world_size.
+    When disk_dir is set, every decoded image is also written there as a .npy
+    shard that is memory mapped on later hits, so decode happens once per file
+    across epochs, runs and DataLoader worker processes, and the pages are
+    shared through the OS page cache.
+    """
+
+    def __init__(self, max_bytes=512 << 20, disk_dir=None):
+        """
+        :param max_bytes: upper bound of the LRU of this process, in bytes (0 disables it)
+        :param disk_dir: directory of the on-disk uint8 shard cache, None to disable
+        """
+        self.max_bytes = int(max_bytes or 0)
+        self.disk_dir = disk_dir
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if self.disk_dir and not os.path.exists(self.disk_dir):
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def __getstate__(self):
+        # DataLoader workers get their own (empty) LRU, the disk shards are shared
+        state = self.__dict__.copy()
+        state['_entries'] = OrderedDict()
+        state['_lock'] = None
+        state['nbytes'] = 0
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, image_path):
+        with self._lock:
+            img = self._entries.get(image_path)
+            if img is not None:
+                self._entries.move_to_end(image_path)
+                self.hits += 1
+                return img
+        img = self._load_shard(image_path)
+        if img is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+        return img
+
+    def put(self, image_path, img):
+        img.flags.writeable = False
+        if self.disk_dir:
+            self._save_shard(image_path, img)
+        if img.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(image_path, None)
+            if old is not None:
+                self.nbytes -= old.nbytes
+            self._entries[image_path] = img
+            self.nbytes += img.nbytes
+            while self.nbytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _shard_path(self, image_path):
+        # key on path + size + mtime so that a rewritten image is decoded again
+        st = os.stat(image_path)
+        key = '{}:{}:{}'.format(os.path.abspath(image_path), st.st_size, st.st_mtime_ns)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.disk_dir, digest[:2], digest + '.npy')
+
+    def _load_shard(self, image_path):
+        if not self.disk_dir:
+            return None
+        shard = self._shard_path(image_path)
+        if not os.path.exists(shard):
+            return None
+        try:
+            return np.load(shard, mmap_mode='r')
+        except (ValueError, OSError):
+            # truncated shard from an interrupted writer, decode again
+            return None
+
+    def _save_shard(self, image_path, img):
+        shard = self._shard_path(image_path)
+        if os.path.exists(shard):
+            return
+        os.makedirs(os.path.dirname(shard), exist_ok=True)
+        tmp = '{}.{}.tmp'.format(shard, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, img)
+        os.replace(tmp, shard)
+
+
+def build_image_cache(config):
+    """
+    Build the ImageCache described by the `data: cache:` section of application.yml
+    :return: ImageCache, or None when caching is not configured
+    """
+    if not config:
+        return None
+    cfg = (config.get('data') or {}).get('cache')
+    if not cfg:
+        return None
+    return ImageCache(max_bytes=cfg.get('max_bytes') or 0, disk_dir=cfg.get('disk_dir'))
+
+
+def decode_image(image_path, cache=None):
+    """
+    function: decode image through the cache
+    :param image_path: input image path
+    :param cache: ImageCache to consult first, None to always decode
+    :return: read-only array as decoded by PIL, H x W x C
+    """
+    if cache is not None:
+        img_data = cache.get(image_path)
+        if img_data is not None:
+            return img_data
+    img_data = np.array(Image.open(image_path))
+    if len(img_data.shape) < 3:
+        img_data = np.dstack((img_data, img_data, img_data))
+    if cache is not None:
+        cache.put(image_path, img_data)
+    return img_data
+
+
+def image_size(image_path, cache=None):
+    """
+    function: image height and width without decoding the pixels
+    :param image_path: input image path
+    :param cache: ImageCache consulted first
+    :return: (h, w)
+    """
+    if cache is not None:
+        img_data = cache.get(image_path)
+        if img_data is not None:
+            return img_data.shape[:2]
+    with Image.open(image_path) as img_file:
+        # PIL only parses the header here
+        w, h = img_file.size
+    return h, w
@@ -4,22 +4,28 @@ import numpy as np
 from PIL import Image
 
 from torch.utils.data import Dataset
+from data.cache import decode_image, image_size
 
 
 # set up
 class RainHazeImageDataset(Dataset):
-    def __init__(self, root_dir, mode, aug=False, transform=None):
+    def __init__(self, root_dir, mode, aug=False, transform=None, cache=None, batch_augment=False):
         """
         At __init__ state, we read in all the image paths of the entire dataset instead of image data
         :param root_dir: directory of files containing the paths to all rain images
         :param mode: 'train', 'val', or 'test'
         :param aug: Whether augment the input image
         :param transform:
+        :param cache: ImageCache shared by all reads, see data/cache.py
+        :param batch_augment: return the uint8 crops, the float conversion, noise and augment
+                              are done per batch by data/augment.BatchAugment
         """
         self.root_dir = root_dir
         self.mode = mode
         self.aug = aug
         self.transform = transform
+        self.cache = cache
+        self.batch_augment = batch_augment
         self.path = os.path.join(self.root_dir, (mode + '_s_rain.txt'))
         self.in_list = generate_new_seq(os.path.join(self.root_dir, (mode + '_in.txt')))
         self.real_list = generate_new_seq(os.path.join(self.root_dir, (mode + '_real.txt')))
@@ -39,23 +45,32 @@ class RainHazeImageDataset(Dataset):
             noise_trigger = False
 
         real_rain_index = np.random.randint(self.no_realrain)
-        rain = read_image(self.in_list[idx], noise_trigger)
-        im_gt = read_image(self.clean_list[idx])  # clean image = input - sparse - middle - dense
-        st_gt = read_image(self.streak_list[idx])  # sparse streak
-        trans_gt = read_image(self.trans_list[idx])  # middle streak
-        atm_gt = read_image(self.atm_list[idx])  # dense streak
-        realrain = read_image(self.real_list[real_rain_index])
+        # pick the crop windows first, only the crops are converted to float and noised
+        crop_size = 224 if self.aug else 256
+        box = random_crop_box(*image_size(self.in_list[idx], self.cache), size=crop_size)
+        real_box = random_crop_box(*image_size(self.real_list[real_rain_index], self.cache), size=crop_size)
+        if self.batch_augment:
+            rain = read_crop(self.in_list[idx], self.cache, box)
+            im_gt = read_crop(self.clean_list[idx], self.cache, box)
+            st_gt = read_crop(self.streak_list[idx], self.cache, box)
+            trans_gt = read_crop(self.trans_list[idx], self.cache, box)
+            atm_gt = read_crop(self.atm_list[idx], self.cache, box)
+            realrain = read_crop(self.real_list[real_rain_index], self.cache, real_box)
+        else:
+            rain = read_image(self.in_list[idx], noise_trigger, self.cache, box)
+            im_gt = read_image(self.clean_list[idx], cache=self.cache, box=box)  # clean image = input - sparse - middle - dense
+            st_gt = read_image(self.streak_list[idx], cache=self.cache, box=box)  # sparse streak
+            trans_gt = read_image(self.trans_list[idx], cache=self.cache, box=box)  # middle streak
+            atm_gt = read_image(self.atm_list[idx], cache=self.cache, box=box)  # dense streak
+            realrain = read_image(self.real_list[real_rain_index], cache=self.cache, box=real_box)
 
         # render haze
         if np.min(trans_gt) == 0:
             print(self.trans_list[idx])
 
         input_list = [rain, st_gt, trans_gt, atm_gt, im_gt, realrain]
-        if self.aug:
-            input_list = augment(input_list)
-        else:
-            # input_list = ImageResize(input_list, size=256)
-            input_list = RandomCrop(input_list, size=256)
+        if self.aug and not self.batch_augment:
+            input_list = augment(input_list, crop_size=None)
 
         if self.transform:
             input_list = self.transform(input_list)
@@ -251,18 +266,56 @@ def write_image(img, path):
         img_file.save(path)
 
 
-def read_image(image_path, noise=False):
+def read_image(image_path, noise=False, cache=None, box=None):
     """
     function: read image function
     :param image_path: input image path
     :param noise: whether apply noise on image
+    :param cache: ImageCache consulted before decoding, None to always decode
+    :param box: (row, col, height, width) window to keep, see random_crop_box.
+                Only this window is converted to float and noised
     :return: image in numpy array, range [0,1]
     """
-    img_file = Image.open(image_path)
-    img_data = np.array(img_file, dtype=np.float32)
-    (h, w, c) = img_data.shape
-    if len(img_data.shape) < 3:
-        img_data = np.dstack((img_data, img_data, img_data))
+    img_data = decode_image(image_path, cache)
+    if box is not None:
+        row, col, height, width = box
+        img_data = img_data[row:row + height, col:col + width]
+    return image_to_float(img_data, noise)
+
+
+def read_crop(image_path, cache=None, box=None):
+    """
+    function: uint8 window of an image, for data/augment.BatchAugment
+    :param image_path: input image path
+    :param cache: ImageCache consulted before decoding, None to always decode
+    :param box: (row, col, height, width) window to keep, see random_crop_box
+    :return: writable uint8 copy of the window, H x W x C
+    """
+    img_data = decode_image(image_path, cache)
+    if box is not None:
+        row, col, height, width = box
+        img_data = img_data[row:row + height, col:col + width]
+    return np.array(img_data, dtype=np.uint8)
+
+
+def random_crop_box(h, w, size=224):
+    """
+    function: draw the window RandomCrop would cut out of an h x w image
+    :return: (row, col, size, size)
+    """
+    row = np.random.randint(h - size)
+    col = np.random.randint(w - size)
+    return row, col, size, size
+
+
+def image_to_float(img_data, noise=False):
+    """
+    function: convert a decoded image to the float range read_image returns
+    :param img_data: H x W x C array in [0,255], e.g. a uint8 slice of a decoded image
+    :param noise: whether apply noise on image
+    :return: image in numpy array, range [0,1]
+    """
+    img_data = img_data.astype(np.float32)
     if noise:
         (h, w, c) = img_data.shape
         noise = np.random.normal(0, 1, [h, w])
@@ -278,21 +331,146 @@ def augment(input_list, scale_limit=300, crop_size=224):
     input_list = RandomHorizontalFlip(input_list)
     input_list = RandomColorWarp(input_list)
     # input_list = RandomScale(rain, streak, clean, size_limit=scale_limit)
-    input_list = RandomCrop(input_list, size=crop_size)
+    if crop_size:
+        input_list = RandomCrop(input_list, size=crop_size)
     return input_list
 
 
 def compute_psnr(est, gt):
-    batch_size = est.size()[0]
-    sum_acc = 0
-    for i in range(batch_size):
-        est_image = est.cpu().data[i].detach().numpy()
-        gt_image = gt.cpu().data[i].detach().numpy()
-        est_image = est_image.transpose((1, 2, 0))
-        gt_image = gt_image.transpose((1, 2, 0))
-        sum_acc += psnr(est_image * 255, gt_image * 255)
-    avg_acc = sum_acc / batch_size
-    return avg_acc
+    # mean of batch_psnr, one host sync per call
+    return batch_psnr(est, gt).mean().item()
+
+
+def tensor_rgb2y(tensor):
+    """
+    function: Y channel of rgb2ycbcr on the device
+    :param tensor: B x 3 x H x W in [0, 255]
+    :return: B x 1 x H x W, floored to uint8 levels like np.uint8 in rgb2ycbcr.
+             Out of range values are clamped to [0, 255], whereas np.uint8 wraps them
+             (256.7 -> 0, -1.3 -> 255; the float to uint8 cast is platform dependent):
+             for outputs that overshoot [0, 1] the result differs from rgb2ycbcr
+    """
+    xform = tensor.new_tensor([.299, .587, .114]).view(1, 3, 1, 1)
+    y = (tensor * xform).sum(dim=1, keepdim=True)
+    return torch.clamp(torch.floor(y), 0, 255)
+
+
+def batch_psnr(est, gt, y_channel=True):
+    """
+    function: per-image PSNR of a batch without leaving the device, same as psnr() on every image
+              whose Y channel stays in [0, 255]; see tensor_rgb2y for out of range values
+    :param est: B x C x H x W in [0, 1]
+    :param gt: ground truth of est
+    :param y_channel: PSNR of the Y channel for 3 channel images
+    :return: tensor of B PSNR values, on the device of est
+    """
+    est = est.detach().double() * 255
+    gt = gt.detach().double() * 255
+    if y_channel and est.size(1) == 3:
+        est = tensor_rgb2y(est)
+        gt = tensor_rgb2y(gt)
+    mse = (est - gt).pow(2).flatten(1).mean(dim=1)
+    return 20 * torch.log10(255 / torch.sqrt(mse))
+
+
+def gaussian_window(size, sigma, tensor):
+    coords = torch.arange(size, dtype=tensor.dtype, device=tensor.device) - (size - 1) / 2.0
+    g = torch.exp(-coords ** 2 / (2 * sigma ** 2))
+    g = g / g.sum()
+    return g.view(1, 1, -1, 1) * g.view(1, 1, 1, -1)
+
+
+def batch_ssim(est, gt, y_channel=True, window_size=11, sigma=1.5):
+    """
+    function: per-image SSIM of a batch without leaving the device
+    Gaussian weighted statistics (11x11, sigma 1.5) over valid windows, on the
+    [0, 255] range, averaged over channels.
+    :param est: B x C x H x W in [0, 1]
+    :param gt: ground truth of est
+    :param y_channel: SSIM of the Y channel for 3 channel images
+    :return: tensor of B SSIM values, on the device of est
+    """
+    est = est.detach().float() * 255
+    gt = gt.detach().float() * 255
+    if y_channel and est.size(1) == 3:
+        est = tensor_rgb2y(est)
+        gt = tensor_rgb2y(gt)
+    c = est.size(1)
+    window = gaussian_window(window_size, sigma, est).expand(c, 1, window_size, window_size)
+    # one depthwise convolution for all five local statistics
+    stats = torch.nn.functional.conv2d(torch.cat((est, gt, est * est, gt * gt, est * gt), dim=1),
+                                       window.repeat(5, 1, 1, 1), groups=5 * c)
+    mu_x, mu_y, xx, yy, xy = stats.split(c, dim=1)
+    var_x = xx - mu_x * mu_x
+    var_y = yy - mu_y * mu_y
+    cov_xy = xy - mu_x * mu_y
+    c1 = (0.01 * 255) ** 2
+    c2 = (0.03 * 255) ** 2
+    ssim_map = ((2 * mu_x * mu_y + c1) * (2 * cov_xy + c2)) / \
+               ((mu_x * mu_x + mu_y * mu_y + c1) * (var_x + var_y + c2))
+    return ssim_map.flatten(1).mean(dim=1)
+
+
+class BatchMetrics(object):
+    """
+    Lazy accumulator of batch_psnr / batch_ssim.
+    Sums stay on the device, update() never synchronizes; sync() copies all
+    averages to the host at once and avg then reads that copy, so it can be
+    printed every iteration like AverageMeter.avg.
+    """
+
+    def __init__(self, ssim=False, y_channel=True):
+        """
+        :param ssim: also accumulate batch_ssim
+        :param y_channel: metrics on the Y channel of 3 channel images
+        """
+        self.ssim = ssim
+        self.y_channel = y_channel
+        self.reset()
+
+    def reset(self):
+        self.sums = {}
+        self.count = 0
+        self.values = {}
+
+    def update(self, est, gt):
+        """
+        :return: the batch_psnr values of this batch, on the device
+        """
+        with torch.no_grad():
+            psnr_values = batch_psnr(est, gt, self.y_channel)
+            self.add('psnr', psnr_values)
+            if self.ssim:
+                self.add('ssim', batch_ssim(est, gt, self.y_channel))
+        self.count += est.size(0)
+        return psnr_values
+
+    def add(self, name, values):
+        total = values.sum()
+        self.sums[name] = total if name not in self.sums else self.sums[name] + total
+
+    def sync(self, reduce=True):
+        """
+        Copy the running averages to the host, the only synchronizing call
+        :param reduce: average over all processes of a distributed run (every process must call sync)
+        :return: dict of metric name to average
+        """
+        if self.count:
+            names = list(self.sums)
+            totals = torch.stack([self.sums[name].double() for name in names]).cpu()
+            count = self.count
+            if reduce and torch.distributed.is_available() and torch.distributed.is_initialized():
+                # every process averages over the samples of all processes (on the host, works with gloo)
+                totals = torch.cat([totals, totals.new_tensor([count])])
+                torch.distributed.all_reduce(totals)
+                totals, count = totals[:-1], totals[-1].item()
+            self.values = {name: total / count for name, total in zip(names, totals.tolist())}
+        return self.values
+
+    @property
+    def avg(self):
+        # PSNR as of the last sync()
+        return self.values.get('psnr', 0)
 
 
 def rgb2ycbcr(im):
@@ -450,6 +628,9 @@ class AverageMeter(object):
         self.count = 0
 
     def update(self, val, n=1):
+        if torch.is_tensor(val):
+            # do not keep the autograd graph of val alive
+            val = val.detach()
         self.val = val
         self.sum += val * n
         self.count += n
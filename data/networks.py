@@ -2,6 +2,7 @@ import torch
 import torch.nn as nn
 from torch.nn import init
 import functools
+from collections import OrderedDict
 from torch.optim import lr_scheduler
 
 ###############################################################################
@@ -136,6 +137,59 @@ class GANLoss(nn.Module):
         return self.loss(input, target_tensor)
 
 
+# Perceptual loss on a truncated VGG16: MSE between the features of the
+# output and of the ground truth at one layer
+class PerceptualLoss(nn.Module):
+    def __init__(self, vgg_model, layer, cache_size=0):
+        """
+        :param vgg_model: torchvision VGG, only features[:layer] is kept
+        :param layer: number of vgg_model.features modules to run; features[:layer]
+                      is Haru.vgg(img, layer + 1) of the old module walk
+        :param cache_size: number of ground truth feature maps kept by sample key,
+                           0 disables the cache
+        """
+        super(PerceptualLoss, self).__init__()
+        self.features = nn.Sequential(*list(vgg_model.features.children())[:layer])
+        for param in self.features.parameters():
+            param.requires_grad = False
+        self.loss = nn.MSELoss()
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def __call__(self, output, target, keys=None):
+        """
+        :param output: B x 3 x H x W
+        :param target: ground truth of output
+        :param keys: sample ids of target, cached features are reused for known
+                     keys; only valid when the ground truth of a key never changes
+                     (fixed crops, no augmentation)
+        """
+        if keys is None or not self.cache_size:
+            # output and ground truth in one batch through the network
+            features = self.features(torch.cat((output, target), dim=0))
+            output_features, target_features = features.split(output.size(0))
+            return self.loss(output_features, target_features.detach())
+
+        missing = [n for n, key in enumerate(keys) if key not in self.cache]
+        if missing:
+            index = torch.tensor(missing, device=target.device)
+            features = self.features(torch.cat((output, target.index_select(0, index)), dim=0))
+            output_features, new_features = features.split((output.size(0), len(missing)))
+            for n, feature in zip(missing, new_features.detach()):
+                self.cache[keys[n]] = feature
+        else:
+            output_features = self.features(output)
+        for key in keys:
+            self.cache.move_to_end(key)
+        target_features = torch.stack([self.cache[key] for key in keys])
+        while len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return self.loss(output_features, target_features.to(output_features.dtype))
+
+    def clear_cache(self):
+        self.cache.clear()
+
+
 # Defines the generator that consists of Resnet blocks between a few
 # downsampling/upsampling operations.
 # Code and idea originally from Justin Johnson's architecture.
@@ -0,0 +1,134 @@
+import os
+import sys
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from data.cache import decode_image
+from data.helper import generate_new_seq, image_to_float, augment, RandomCrop
+
+# order of the per-sample components, same as the input_list of RainHazeImageDataset
+PACKED_COMPONENTS = ('in', 'streak', 'trans', 'atm', 'clean')
+
+
+def packed_paths(root_dir, mode):
+    prefix = os.path.join(root_dir, mode + '_packed')
+    return prefix + '.bin', prefix + '.idx.npz'
+
+
+def pack_rain_haze_dataset(root_dir, mode, verbose=True):
+    """
+    One-shot converter from the six filelists of RainHazeImageDataset to the packed format.
+    Every image is decoded once and appended as raw uint8 H x W x C bytes to
+    <mode>_packed.bin; <mode>_packed.idx.npz holds the (offset, h, w, c) rows of
+    the five per-sample components and of the real rain images.
+    :param root_dir: directory of files containing the paths to all rain images
+    :param mode: 'train', 'val', or 'test'
+    :return: paths of the data and the index file
+    """
+    lists = [generate_new_seq(os.path.join(root_dir, '{}_{}.txt'.format(mode, name)))
+             for name in PACKED_COMPONENTS]
+    real_list = generate_new_seq(os.path.join(root_dir, mode + '_real.txt'))
+    num_samples = len(lists[0])
+    for name, file_list in zip(PACKED_COMPONENTS, lists):
+        if len(file_list) != num_samples:
+            raise ValueError('{}_{}.txt has {} entries, expected {}'.format(
+                mode, name, len(file_list), num_samples))
+
+    data_path, index_path = packed_paths(root_dir, mode)
+    samples = np.zeros((num_samples, len(PACKED_COMPONENTS), 4), dtype=np.int64)
+    real = np.zeros((len(real_list), 4), dtype=np.int64)
+    offset = 0
+    tmp_path = data_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        def append(path):
+            img = np.ascontiguousarray(decode_image(path), dtype=np.uint8)
+            f.write(img.tobytes())
+            row = (offset,) + img.shape
+            return row, offset + img.nbytes
+
+        for idx in range(num_samples):
+            for j, file_list in enumerate(lists):
+                samples[idx, j], offset = append(file_list[idx])
+            if verbose:
+                print('\rPacking %s %d/%d' % (mode, idx + 1, num_samples), end=' ')
+        for idx, path in enumerate(real_list):
+            real[idx], offset = append(path)
+    os.replace(tmp_path, data_path)
+    np.savez(index_path, samples=samples, real=real)
+    if verbose:
+        print('\n[*] Packed {} samples, {} real rain images, {:.1f} MB into {}'.format(
+            num_samples, len(real_list), offset / 2.0 ** 20, data_path))
+    return data_path, index_path
+
+
+class PackedRainHazeDataset(Dataset):
+    def __init__(self, root_dir, mode, aug=False, transform=None, batch_augment=False):
+        """
+        Drop-in for RainHazeImageDataset reading the output of pack_rain_haze_dataset.
+        Images are zero-copy views into one memory-mapped file, they are only
+        converted to float once cropped.
+        :param root_dir: directory holding <mode>_packed.bin and <mode>_packed.idx.npz
+        :param mode: 'train', 'val', or 'test'
+        :param aug: Whether augment the input image
+        :param transform:
+        :param batch_augment: return the uint8 crops, the float conversion, noise and augment
+                              are done per batch by data/augment.BatchAugment
+        """
+        self.root_dir = root_dir
+        self.mode = mode
+        self.aug = aug
+        self.transform = transform
+        self.batch_augment = batch_augment
+        self.data_path, index_path = packed_paths(root_dir, mode)
+        index = np.load(index_path)
+        self.samples = index['samples']
+        self.real = index['real']
+        self.no_realrain = len(self.real)
+        self._data = None
+
+    def __getstate__(self):
+        # every DataLoader worker maps the file itself instead of pickling it
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+    def __len__(self):
+        return len(self.samples)
+
+    def image(self, row):
+        if self._data is None:
+            self._data = np.memmap(self.data_path, dtype=np.uint8, mode='r')
+        offset, h, w, c = row
+        return self._data[offset:offset + h * w * c].reshape(h, w, c)
+
+    def __getitem__(self, idx):
+        noise_trigger = self.mode == 'train'
+
+        real_rain_index = np.random.randint(self.no_realrain)
+        input_list = [self.image(row) for row in self.samples[idx]]
+        input_list.append(self.image(self.real[real_rain_index]))
+        noise_list = [noise_trigger] + [False] * (len(input_list) - 1)
+
+        input_list = RandomCrop(input_list, size=224 if self.aug else 256)
+        if self.batch_augment:
+            # writable copies of the crops, the map itself is read-only
+            input_list = [np.array(img) for img in input_list]
+        else:
+            input_list = [image_to_float(img, noise) for img, noise in zip(input_list, noise_list)]
+            if self.aug:
+                input_list = augment(input_list, crop_size=None)
+
+        if self.transform:
+            input_list = self.transform(input_list)
+
+        return input_list
+
+
+if __name__ == '__main__':
+    # python -m data.packed <filelist dir> [train|val|test ...]
+    if len(sys.argv) < 2:
+        print('usage: python -m data.packed root_dir [mode ...]')
+        sys.exit(1)
+    for mode in sys.argv[2:] or ['train', 'val']:
+        pack_rain_haze_dataset(sys.argv[1], mode)
@@ -3,6 +3,7 @@
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
+import torch.fx
 
 
 
@@ -47,6 +48,18 @@ class down(nn.Module):
         return x
 
 
+def pad_like(x2, x1):
+    # pad x2 by the size difference to x1, the alignment of up();
+    # one call in torch.fx graphs (quantize.py), int() of a traced size can not be traced
+    diffX = x1.size()[2] - x2.size()[2]
+    diffY = x1.size()[3] - x2.size()[3]
+    return F.pad(x2, (diffX // 2, int(diffX / 2),
+                      diffY // 2, int(diffY / 2)))
+
+
+torch.fx.wrap('pad_like')
+
+
 class up(nn.Module):
     def __init__(self, in_ch, out_ch, bilinear=True):
         super(up, self).__init__()
@@ -62,10 +75,7 @@ class up(nn.Module):
 
     def forward(self, x1, x2):
         x1 = self.up(x1)
-        diffX = x1.size()[2] - x2.size()[2]
-        diffY = x1.size()[3] - x2.size()[3]
-        x2 = F.pad(x2, (diffX // 2, int(diffX / 2),
-                        diffY // 2, int(diffY / 2)))
+        x2 = pad_like(x2, x1)
         x = torch.cat([x2, x1], dim=1)
         x = self.conv(x)
         return x
@@ -0,0 +1,176 @@
+import os
+import contextlib
+from collections import OrderedDict
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data.distributed import DistributedSampler
+
+# 多进程数据并行训练 (DistributedDataParallel)
+# 默认 gloo 后端, 只有CPU的Linux节点也能用; 每个进程分到 cpu_count / world_size 个线程
+# application.yml:
+#   train:
+#     distributed:
+#       world_size: 4
+
+
+def launch(fn, world_size, args=(), backend='gloo', master_addr='127.0.0.1', master_port=29500):
+    """
+    Run fn(rank, world_size, *args) in world_size processes with the process group set up.
+    Under torchrun (RANK / WORLD_SIZE in the environment) the current process joins
+    the group and runs fn itself; world_size <= 1 runs fn in-process without a group.
+    """
+    if 'RANK' in os.environ and 'WORLD_SIZE' in os.environ:
+        rank = int(os.environ['RANK'])
+        world_size = int(os.environ['WORLD_SIZE'])
+        _run(rank, fn, world_size, args, backend, None, None)
+    elif world_size <= 1:
+        fn(0, 1, *args)
+    else:
+        mp.spawn(_run, args=(fn, world_size, args, backend, master_addr, master_port),
+                 nprocs=world_size, join=True)
+
+
+def _run(rank, fn, world_size, args, backend, master_addr, master_port):
+    init(rank, world_size, backend, master_addr, master_port)
+    try:
+        fn(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def init(rank, world_size, backend='gloo', master_addr=None, master_port=None):
+    if master_addr:
+        os.environ['MASTER_ADDR'] = str(master_addr)
+    if master_port:
+        os.environ['MASTER_PORT'] = str(master_port)
+    if backend == 'nccl':
+        torch.cuda.set_device(rank % torch.cuda.device_count())
+    dist.init_process_group(backend, rank=rank, world_size=world_size)
+    # the cores of the node are split between the workers
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    # the picklable obj of rank src on every process, obj itself when not distributed
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src)
+    return objects[0]
+
+
+def all_reduce(tensor, average=True):
+    """
+    Sum (or average) a tensor over all processes
+    :return: reduced copy on the device of tensor, tensor itself when not distributed
+    """
+    if not is_distributed():
+        return tensor
+    reduced = tensor.detach().clone()
+    if dist.get_backend() == 'gloo':
+        reduced = reduced.cpu()
+    dist.all_reduce(reduced)
+    if average:
+        reduced /= get_world_size()
+    return reduced.to(tensor.device)
+
+
+def wrap_model(model, device, find_unused_parameters=False):
+    """
+    DistributedDataParallel around model when the process group is up, model otherwise.
+    Only the parameters that require grad at this point are synchronized.
+    :param find_unused_parameters: for models whose forward leaves trainable parameters out of the loss
+    """
+    if not is_distributed():
+        return model
+    if isinstance(model, DistributedDataParallel):
+        return model
+    device = torch.device(device)
+    if device.type == 'cuda':
+        return DistributedDataParallel(model, device_ids=[device], find_unused_parameters=find_unused_parameters)
+    return DistributedDataParallel(model, find_unused_parameters=find_unused_parameters)
+
+
+def unwrap_model(model):
+    # the module under DataParallel / DistributedDataParallel, so state_dicts never carry 'module.'
+    if isinstance(model, (torch.nn.DataParallel, DistributedDataParallel)):
+        return model.module
+    return model
+
+
+def broadcast_parameters(model, src=0):
+    # copy the parameters and buffers of rank src to every process, e.g. after re-initializing a model
+    if not is_distributed():
+        return
+    for tensor in unwrap_model(model).state_dict().values():
+        if dist.get_backend() == 'gloo' and tensor.is_cuda:
+            host = tensor.cpu()
+            dist.broadcast(host, src)
+            tensor.copy_(host)
+        else:
+            dist.broadcast(tensor, src)
+
+
+# key prefixes added by the wrappers of a model: DataParallel / DistributedDataParallel, torch.compile
+MODULE_PREFIXES = ('module.', '_orig_mod.')
+
+
+def strip_module_prefix(state_dict):
+    # state_dict keys of the bare model, whatever wrapped the model when it was saved
+    def strip(key):
+        while True:
+            for prefix in MODULE_PREFIXES:
+                if key.startswith(prefix):
+                    key = key[len(prefix):]
+                    break
+            else:
+                return key
+    return OrderedDict((strip(k), v) for k, v in state_dict.items())
+
+
+def no_sync(model, skip=True):
+    # skip the gradient all-reduce of a DDP model, for micro-batches inside an accumulation window
+    if skip and isinstance(model, DistributedDataParallel):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def distributed_sampler(dataset, shuffle):
+    """
+    DistributedSampler sharding dataset over the processes, None when not distributed
+    (pass shuffle=False to the DataLoader together with a sampler)
+    """
+    if not is_distributed():
+        return None
+    return DistributedSampler(dataset, shuffle=shuffle, drop_last=True)
+
+
+def set_epoch(data_loader, epoch):
+    # reshuffle the shards of a DistributedSampler every epoch
+    sampler = getattr(data_loader, 'sampler', None)
+    if isinstance(sampler, DistributedSampler):
+        sampler.set_epoch(epoch)
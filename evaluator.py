@@ -0,0 +1,249 @@
+import os
+import time
+import queue
+
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from skimage.transform import resize
+
+from model import DecompModel
+from data.helper import generate_new_seq, read_image, write_tensor, BatchMetrics
+from data.cache import decode_image, image_size
+
+# 每个 epoch 的验证
+# 验证集只解码一次: 固定随机种子裁剪, 以 uint8 张量保存在内存里 (ValidationStore)
+# background 为 true 时在单独的进程里评估 G 的 CPU 快照, 训练同时进行下一个 epoch
+# 真实雨图 (test_input_dir) 只对 test_samples 张出预览图
+
+STORE_LISTS = (('rain', 'in'), ('streak', 'streak'), ('trans', 'trans'), ('atm', 'atm'), ('clean', 'clean'))
+
+
+class ValidationStore(object):
+    """
+    The images of a filelist split decoded once into uint8 N x 3 x S x S tensors.
+    The crop windows are drawn with a fixed seed, every epoch sees the same crops;
+    batches() returns the float values read_image would give for them.
+    """
+
+    def __init__(self, root_dir, mode='val', crop_size=256, seed=0, max_images=None, cache=None):
+        """
+        :param root_dir: directory of the <mode>_in.txt / _streak / _trans / _atm / _clean filelists
+        :param max_images: only the first max_images images of the list
+        :param cache: ImageCache used for decoding, see data/cache.py
+        """
+        lists = [generate_new_seq(os.path.join(root_dir, mode + '_' + suffix + '.txt'))
+                 for _, suffix in STORE_LISTS]
+        num = len(lists[0]) if not max_images else min(len(lists[0]), max_images)
+        rng = np.random.RandomState(seed)
+        self.tensors = {name: torch.empty((num, 3, crop_size, crop_size), dtype=torch.uint8)
+                        for name, _ in STORE_LISTS}
+        for i in range(num):
+            # same window for all images of a sample, drawn like random_crop_box
+            h, w = image_size(lists[0][i], cache)
+            row = rng.randint(h - crop_size)
+            col = rng.randint(w - crop_size)
+            for (name, _), files in zip(STORE_LISTS, lists):
+                img = decode_image(files[i], cache)[row:row + crop_size, col:col + crop_size, :3]
+                self.tensors[name][i] = torch.from_numpy(np.ascontiguousarray(img.transpose(2, 0, 1)))
+
+    def __len__(self):
+        return self.tensors['rain'].size(0)
+
+    @property
+    def nbytes(self):
+        return sum(t.numel() for t in self.tensors.values())
+
+    def share_memory_(self):
+        # the evaluation process maps the same pages instead of a copy
+        for t in self.tensors.values():
+            t.share_memory_()
+        return self
+
+    def batches(self, batch_size, device='cpu'):
+        """
+        :return: iterator of [rain, streak, trans, atm, clean] float batches in [0, 1] on device
+        """
+        for start in range(0, len(self), batch_size):
+            yield [self.tensors[name][start:start + batch_size].to(device).float() / 255.0
+                   for name, _ in STORE_LISTS]
+
+
+def sample_files(test_dir, num):
+    """
+    :param num: number of images, evenly spread over the sorted directory; None or 0 for all
+    :return: paths of the real rain images previewed every epoch
+    """
+    if not test_dir or not os.path.isdir(test_dir):
+        return []
+    files = sorted(os.listdir(test_dir))
+    if num and num < len(files):
+        files = [files[i] for i in np.unique(np.linspace(0, len(files) - 1, num).astype(int))]
+    return [os.path.join(test_dir, f) for f in files]
+
+
+def evaluate(G, store, epoch, batch_size=8, preview_every=100, test_files=(), image_size=512, device='cpu'):
+    """
+    Validation of G over store: PSNR / SSIM of the streak estimate, as Haru.validate measured it.
+    Writes val/<epoch>/<i>.png for every preview_every-th batch and out/<epoch>/<name> for test_files.
+    :return: dict of epoch, psnr, ssim, time
+    """
+    start = time.time()
+    metrics = BatchMetrics(ssim=True)
+    val_dir = 'val/' + str(epoch) + '/'
+    if not os.path.exists(val_dir):
+        os.makedirs(val_dir)
+    with torch.no_grad():
+        for i, inputs in enumerate(store.batches(batch_size, device)):
+            image_in_var = inputs[0]
+            st_out, trans_out, atm_out, clean_out = G(image_in_var)
+            clean_out = (image_in_var - st_out - (1 - trans_out) * atm_out) / (trans_out + 0.0001)
+            metrics.update(st_out, inputs[1])
+            if preview_every and i % preview_every == 0:
+                recons = (image_in_var - (1 - trans_out) * atm_out) / (trans_out + 0.0001) - st_out
+                input_row = torch.cat([t[:1] for t in inputs], dim=3)
+                output_row = torch.cat([t[:1] for t in (recons, st_out, trans_out, atm_out, clean_out)], dim=3)
+                write_tensor(torch.cat((input_row, output_row), dim=2), val_dir + str(i) + '.png')
+        # only this process saw the validation set, no all-reduce
+        values = metrics.sync(reduce=False)
+        if test_files:
+            render_previews(G, test_files, 'out/' + str(epoch) + '/', image_size, device)
+    return {'epoch': epoch, 'psnr': values.get('psnr', 0), 'ssim': values.get('ssim', 0),
+            'time': time.time() - start}
+
+
+def render_previews(G, files, outdir, image_size, device='cpu'):
+    # the painter of Haru.predict_resize for each file
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    for filename in files:
+        rain_image = resize(read_image(filename, noise=False), [image_size, image_size])
+        input_var = torch.from_numpy(rain_image.transpose(2, 0, 1)).float().unsqueeze(0).to(device)
+        st_out, trans_out, atm_out, clean_out = G(input_var)
+        recons = (input_var - (1 - trans_out) * atm_out) / (trans_out + 0.0001) - st_out
+        painter1 = torch.cat([input_var, st_out, trans_out], dim=3)
+        painter2 = torch.cat([recons, clean_out, atm_out], dim=3)
+        write_tensor(torch.cat([painter1, painter2], dim=2), os.path.join(outdir, os.path.basename(filename)))
+
+
+def _worker(store, options, threads, jobs, results):
+    # evaluation process: one DecompModel on the CPU, reloaded with each snapshot
+    if threads:
+        torch.set_num_threads(threads)
+    G = DecompModel()
+    while True:
+        job = jobs.get()
+        if job is None:
+            return
+        epoch, state = job
+        try:
+            G.load_state_dict(state)
+            results.put(evaluate(G, store, epoch, **options))
+        except Exception as e:
+            results.put({'epoch': epoch, 'error': repr(e)})
+
+
+class Evaluator(object):
+    """
+    Per-epoch validation on a ValidationStore.
+    In the foreground submit() evaluates G right away and returns the result;
+    in the background it sends a CPU snapshot of G to the evaluation process and
+    returns None, the result is collected later by results().
+    """
+
+    def __init__(self, store, test_files=(), image_size=512, batch_size=8, preview_every=100,
+                 device='cpu', background=False, threads=0):
+        self.store = store
+        self.options = {'batch_size': batch_size, 'preview_every': preview_every,
+                        'test_files': list(test_files), 'image_size': image_size}
+        self.device = device
+        self.background = background
+        self.threads = threads
+        self.process = None
+        self.pending = 0
+        # seconds between the liveness checks of the evaluation process while waiting
+        self.poll_interval = 5.0
+
+    def start(self):
+        ctx = mp.get_context('spawn')
+        self.jobs = ctx.Queue()
+        self.results_queue = ctx.Queue()
+        self.process = ctx.Process(target=_worker, daemon=True,
+                                   args=(self.store.share_memory_(), self.options, self.threads,
+                                         self.jobs, self.results_queue))
+        self.process.start()
+
+    def submit(self, G, epoch):
+        """
+        :param G: the bare DecompModel (not wrapped in DataParallel / DDP)
+        :return: result dict in the foreground, None in the background
+        """
+        if not self.background:
+            return evaluate(G, self.store, epoch, device=self.device, **self.options)
+        if self.process is None:
+            self.start()
+        state = {k: v.detach().to('cpu', copy=True) for k, v in G.state_dict().items()}
+        self.jobs.put((epoch, state))
+        self.pending += 1
+        return None
+
+    def results(self, block=False):
+        """
+        :param block: wait for every submitted evaluation
+        :return: list of the result dicts that arrived, errors are printed and dropped.
+                 If the evaluation process died (OOM kill, crash) its pending evaluations
+                 are dropped and the next submit() starts a new one
+        """
+        out = []
+        while self.pending:
+            try:
+                result = self.results_queue.get(timeout=self.poll_interval) if block else \
+                    self.results_queue.get(block=False)
+            except queue.Empty:
+                if not self.process.is_alive():
+                    print('\nValidation process exited with code {}, {} evaluation(s) lost'.format(
+                        self.process.exitcode, self.pending))
+                    self.pending = 0
+                    self.process = None
+                    break
+                if block:
+                    continue
+                break
+            self.pending -= 1
+            if 'error' in result:
+                print('\nValidation of epoch {} failed: {}'.format(result['epoch'], result['error']))
+                continue
+            out.append(result)
+        return out
+
+    def close(self):
+        if self.process is not None:
+            self.jobs.put(None)
+            self.process.join()
+            self.process = None
+
+
+def build_evaluator(config, val_dir, test_dir, image_size, batch_size, device='cpu', cache=None):
+    """
+    Build the Evaluator described by the `eval:` section of application.yml
+    (background, threads, crop_size, seed, max_images, batch_size, preview_every, test_samples)
+    """
+    cfg = (config or {}).get('eval') or {}
+    tic = time.time()
+    store = ValidationStore(val_dir, 'val', crop_size=cfg.get('crop_size') or 256, seed=cfg.get('seed') or 0,
+                            max_images=cfg.get('max_images'), cache=cache)
+    print('[*] Validation set: {} images decoded in {:.1f}s, {:.1f} MB'.format(
+        len(store), time.time() - tic, store.nbytes / 2 ** 20))
+    background = bool(cfg.get('background'))
+    threads = cfg.get('threads')
+    if background and threads is None:
+        # leave most of the cores to training
+        threads = max(1, (os.cpu_count() or 1) // 4)
+    every = cfg.get('preview_every')
+    return Evaluator(store, sample_files(test_dir, cfg.get('test_samples')),
+                     image_size=image_size,
+                     batch_size=cfg.get('batch_size') or batch_size,
+                     preview_every=100 if every is None else every,
+                     device='cpu' if background else device,
+                     background=background,
+                     threads=threads or 0)
@@ -0,0 +1,185 @@
+import os
+import sys
+import copy
+import time
+import argparse
+from typing import List, Tuple
+
+import torch
+import torch.nn as nn
+
+from data.helper import get_residue
+
+# 导出推理模型: haru export
+# DecompModel (分解/FogNet/RainNet/RefUNet/去雾公式 + predict_atm) 脚本化并冻结为一个 TorchScript 文件,
+# 不含 VGG / D / 优化器; 服务端用 serving.py 加载, 只依赖 torch
+# python main.py export --ckpt ckpt/pretrained2.pth.tar --output out/haru_G.pt
+
+
+def tile_offsets(size, patch):
+    # type: (int, int) -> Tuple[List[int], List[int]]
+    # DecompModel.tile_offsets: tile starts along one axis, a partial last tile is moved back to size - patch
+    offsets = torch.jit.annotate(List[int], [])
+    rates = torch.jit.annotate(List[int], [])
+    for i in range((size + patch - 1) // patch):
+        if (i + 1) * patch > size:
+            offsets.append(size - patch)
+            rates.append(size - i * patch)
+        else:
+            offsets.append(i * patch)
+            rates.append(1)
+    return offsets, rates
+
+
+class InferenceModel(nn.Module):
+    """
+    The inference path of a trained DecompModel as one scriptable module,
+    in fp32 and without the autocast / device handling of the training code.
+    forward(x) is DecompModel.forward, predict_atm(x) and run(x, A) are
+    DecompModel.predict_atm and forward_test(x, A, mode='run').
+    """
+
+    def __init__(self, G):
+        """
+        :param G: DecompModel, its sub-networks are shared, not copied
+        """
+        super(InferenceModel, self).__init__()
+        self.gf = G.gf
+        self.atmconv1x1 = G.fognet.atmconv1x1
+        self.atmnet = G.fognet.atmnet
+        self.transnet = G.fognet.transnet
+        self.rainnet = G.rainnet
+        self.ref = G.ref
+        self.relu = nn.ReLU()
+        self.eps = float(G.eps)
+        self.patch = 256
+        self.atm_margin = G.atm_margin()
+
+    def decomposition(self, x):
+        return self.gf(get_residue(x), x)
+
+    def estimate_atm(self, x):
+        return self.relu(self.atmnet(self.atmconv1x1(x)))
+
+    def decompose(self, x):
+        # streak, trans, atm and A of the top-left crop, as DecompModel.forward computes them
+        h = x.size(2)
+        w = x.size(3)
+        lf, hf = self.decomposition(x)
+        x_lf = torch.cat([x, lf], dim=1)
+        A = self.estimate_atm(x_lf[:, :, 0:self.patch, 0:self.patch])
+        trans = self.relu(self.transnet(x_lf)).repeat(1, 3, 1, 1)
+        atm = A.repeat(1, 1, h, w)
+        streak = self.rainnet(torch.cat([x, hf], dim=1)).repeat(1, 3, 1, 1)
+        return streak, trans, atm, A
+
+    def forward(self, x):
+        streak, trans, atm, A = self.decompose(x)
+        dehaze = (x - (1 - trans) * atm) / (trans + self.eps) - streak
+        clean = self.relu(self.ref(dehaze, A))
+        return streak, trans, atm, clean
+
+    @torch.jit.export
+    def run(self, x, A):
+        # the clean image is refined with the given A, e.g. the image-wide one of predict_atm
+        streak, trans, atm, _ = self.decompose(x)
+        dehaze = (x - (1 - trans) * atm) / (trans + self.eps) - streak
+        clean = self.relu(self.ref(dehaze, A))
+        return streak, trans, atm, clean
+
+    @torch.jit.export
+    def predict_atm(self, x, tile_batch=64):
+        # type: (Tensor, int) -> Tensor
+        # weighted mean of the A of every 256x256 tile, each decomposed on its own window
+        # of atm_margin context pixels, tile_batch tiles at a time; see DecompModel.predict_atm
+        b = x.size(0)
+        h = x.size(2)
+        w = x.size(3)
+        offsets_y, rates_y = tile_offsets(h, self.patch)
+        offsets_x, rates_x = tile_offsets(w, self.patch)
+        jobs = torch.jit.annotate(List[Tuple[int, int, int]], [])
+        for i in range(b):
+            for y0 in offsets_y:
+                for x0 in offsets_x:
+                    jobs.append((i, y0, x0))
+        A_list = torch.jit.annotate(List[torch.Tensor], [])
+        for k in range(0, len(jobs), tile_batch):
+            tiles = torch.jit.annotate(List[torch.Tensor], [])
+            for i, y0, x0 in jobs[k:k + tile_batch]:
+                top = max(y0 - self.atm_margin, 0)
+                left = max(x0 - self.atm_margin, 0)
+                window = x[i:i + 1, :, top:min(y0 + self.patch + self.atm_margin, h),
+                           left:min(x0 + self.patch + self.atm_margin, w)]
+                lf, hf = self.decomposition(window)
+                tile = torch.cat([window, lf], dim=1)
+                tiles.append(tile[:, :, y0 - top:y0 - top + self.patch, x0 - left:x0 - left + self.patch])
+            A_list.append(self.estimate_atm(torch.cat(tiles, dim=0)))
+        A = torch.cat(A_list, dim=0).view(b, len(offsets_y) * len(offsets_x), 3, 1, 1)
+        rate = torch.tensor(rates_y, dtype=A.dtype, device=A.device).view(-1, 1) * \
+            torch.tensor(rates_x, dtype=A.dtype, device=A.device).view(1, -1)
+        rate = rate.view(1, -1, 1, 1, 1)
+        return (A * rate).sum(dim=1) / rate.sum()
+
+
+def export(G, path, freeze=True, optimize=False):
+    """
+    Script (and freeze) the inference path of G and save it
+    :param G: DecompModel with the trained weights, exported from a CPU eval copy (G is not changed)
+    :param freeze: inline the weights as constants and fold the graph (torch.jit.freeze)
+    :param optimize: torch.jit.optimize_for_inference on the frozen graph (conv + ReLU fusion on CPU)
+    :return: the saved ScriptModule
+    """
+    model = InferenceModel(copy.deepcopy(G).cpu().eval()).eval()
+    scripted = torch.jit.script(model)
+    if freeze or optimize:
+        scripted = torch.jit.freeze(scripted, preserved_attrs=['run', 'predict_atm'])
+    if optimize:
+        scripted = torch.jit.optimize_for_inference(scripted, other_methods=['run', 'predict_atm'])
+    scripted.save(path)
+    return scripted
+
+
+def verify(G, scripted, image_size=512):
+    """
+    Compare the exported module with G on a random image
+    :return: dict of output name to max abs difference
+    """
+    x = torch.rand(1, 3, image_size, image_size)
+    report = {}
+    with torch.no_grad():
+        expected = G(x)
+        for name, a, b in zip(('streak', 'trans', 'atm', 'clean'), expected, scripted(x)):
+            report[name] = (a - b).abs().max().item()
+        A = G.predict_atm(x)
+        report['predict_atm'] = (A - scripted.predict_atm(x)).abs().max().item()
+        expected = G.forward_test(x, A, mode='run')
+        for name, a, b in zip(('streak', 'trans', 'atm', 'clean'), expected, scripted.run(x, A)):
+            report['run_' + name] = (a - b).abs().max().item()
+    return report
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='haru export', description='Export DecompModel as a TorchScript file')
+    parser.add_argument('--ckpt', required=True, help='checkpoint with the generator weights (G)')
+    parser.add_argument('--output', default='out/haru_G.pt', help='TorchScript file to write')
+    parser.add_argument('--no_freeze', action='store_true', help='keep the weights as parameters')
+    parser.add_argument('--image_size', type=int, default=512, help='size of the verification image')
+    return parser
+
+
+def main(argv=None):
+    # the training stack is only needed here, serving.py loads the result with torch alone
+    from infer import load_generator
+    args = build_parser().parse_args(argv)
+    if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
+        os.makedirs(os.path.dirname(args.output))
+    G = load_generator(args.ckpt, 'cpu')
+    tic = time.time()
+    scripted = export(G, args.output, freeze=not args.no_freeze)
+    print('[*] Exported {} in {:.1f}s'.format(args.output, time.time() - tic))
+    for name, diff in verify(G, scripted, args.image_size).items():
+        print('{:<16}max abs diff {:.3e}'.format(name, diff))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,210 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+
+import numpy as np
+import torch
+from skimage.transform import resize
+
+from model import DecompModel
+from data.helper import read_image, write_image, generate_new_seq
+from utility import read_checkpoint
+
+# 推理: haru infer
+# 解码线程池 -> 批量前向 -> 编码/写入线程池, 各阶段之间是有界队列
+# python main.py infer --ckpt ckpt/pretrained2.pth.tar --input real_rain/ --output out/infer --outputs clean,trans
+
+OUTPUTS = ('clean', 'trans', 'streak', 'atm')
+IMAGE_EXT = ('.png', '.jpg', '.jpeg', '.bmp', '.tif', '.tiff')
+_STOP = None
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='haru infer', description='Stream rain images through DecompModel')
+    parser.add_argument('--ckpt', required=True, help='checkpoint with the generator weights (G)')
+    parser.add_argument('--input', required=True, help='image directory or filelist in the generate_new_seq format')
+    parser.add_argument('--output', default='out/infer', help='output directory')
+    parser.add_argument('--outputs', default='clean', help='comma separated subset of ' + ','.join(OUTPUTS))
+    parser.add_argument('--image_size', type=int, default=512, help='resize to this size, ignored with --tile')
+    parser.add_argument('--tile', type=int, default=0, help='full resolution with tiles of this size (see forward_tiled)')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--decode_workers', type=int, default=4)
+    parser.add_argument('--write_workers', type=int, default=4)
+    parser.add_argument('--queue_size', type=int, default=32, help='bound of the queues between the stages')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    return parser
+
+
+def list_inputs(path):
+    if os.path.isdir(path):
+        names = sorted(f for f in os.listdir(path) if f.lower().endswith(IMAGE_EXT))
+        return [os.path.join(path, f) for f in names]
+    return generate_new_seq(path)
+
+
+def load_generator(ckpt_path, device):
+    G = DecompModel().to(device)
+    # memory-mapped read of G only, copied straight into the parameters on device
+    G.load_state_dict(read_checkpoint(ckpt_path, ('G',))['G'])
+    return G.eval()
+
+
+def output_names(files):
+    """
+    :return: dict of input path to output name, the path relative to the common directory
+             of the inputs without extension; a name already taken by another input
+             (same stem, other extension) gets the index of the input appended
+    """
+    if not files:
+        return {}
+    root = os.path.commonpath([os.path.dirname(os.path.abspath(f)) for f in files])
+    names = {}
+    taken = set()
+    for i, f in enumerate(files):
+        if f in names:
+            continue
+        name = os.path.splitext(os.path.relpath(os.path.abspath(f), root))[0]
+        if name in taken:
+            name = '{}_{}'.format(name, i)
+        taken.add(name)
+        names[f] = name
+    return names
+
+
+class InferencePipeline(object):
+    def __init__(self, G, args):
+        self.G = G
+        self.args = args
+        self.outputs = [o for o in args.outputs.split(',') if o]
+        for o in self.outputs:
+            if o not in OUTPUTS:
+                raise ValueError('Unknown output "{}", expected one of {}'.format(o, OUTPUTS))
+        self.device = torch.device(args.device)
+        self.paths = queue.Queue()
+        self.decoded = queue.Queue(maxsize=args.queue_size)
+        self.encoded = queue.Queue(maxsize=args.queue_size)
+        self.errors = []
+        self.writers = []
+        self.names = {}
+
+    def decode_worker(self):
+        while True:
+            path = self.paths.get()
+            if path is _STOP:
+                self.decoded.put(_STOP)
+                return
+            try:
+                image = read_image(path, noise=False)
+                if not self.args.tile:
+                    image = resize(image, [self.args.image_size, self.args.image_size]).astype(np.float32)
+                self.decoded.put((path, np.ascontiguousarray(image.transpose(2, 0, 1))))
+            except Exception as e:
+                print('\nFailed to read {}: {}'.format(path, e))
+                self.errors.append(path)
+
+    def write_worker(self):
+        while True:
+            item = self.encoded.get()
+            if item is _STOP:
+                return
+            path, image = item
+            try:
+                write_image(image.transpose(1, 2, 0), path)
+            except Exception as e:
+                print('\nFailed to write {}: {}'.format(path, e))
+                self.errors.append(path)
+
+    def put_encoded(self, item):
+        # the queue is bounded: with every writer gone a plain put() would block forever
+        while True:
+            try:
+                self.encoded.put(item, timeout=1.0)
+                return
+            except queue.Full:
+                if not any(t.is_alive() for t in self.writers):
+                    raise RuntimeError('All write workers exited, {} outputs left unwritten'.format(
+                        self.encoded.qsize() + 1))
+
+    def forward(self, batch):
+        with torch.no_grad():
+            x = torch.from_numpy(np.stack(batch)).to(self.device)
+            if self.args.tile:
+                A = self.G.predict_atm(x)
+                streak, trans, atm, clean = self.G.forward_test(x, A, mode='run', tile=self.args.tile)
+            else:
+                streak, trans, atm, clean = self.G(x)
+            out = {'clean': clean, 'trans': trans, 'streak': streak, 'atm': atm}
+            # one device-to-host copy per requested output and batch
+            return {o: out[o].float().cpu().numpy() for o in self.outputs}
+
+    def submit(self, names, batch):
+        out = self.forward(batch)
+        for i, name in enumerate(names):
+            stem = os.path.join(self.args.output, self.names[name])
+            if not os.path.exists(os.path.dirname(stem)):
+                os.makedirs(os.path.dirname(stem))
+            for o in self.outputs:
+                self.put_encoded(('{}_{}.png'.format(stem, o), out[o][i]))
+
+    def run(self, files):
+        if not os.path.exists(self.args.output):
+            os.makedirs(self.args.output)
+        self.names = output_names(files)
+        for f in files:
+            self.paths.put(f)
+        for _ in range(self.args.decode_workers):
+            self.paths.put(_STOP)
+        decoders = [threading.Thread(target=self.decode_worker, daemon=True)
+                    for _ in range(self.args.decode_workers)]
+        writers = [threading.Thread(target=self.write_worker, daemon=True)
+                   for _ in range(self.args.write_workers)]
+        self.writers = writers
+        for t in decoders + writers:
+            t.start()
+
+        # tiles are batched inside forward_tiled, images of different size can not be stacked
+        batch_size = 1 if self.args.tile else self.args.batch_size
+        tic = time.time()
+        count = 0
+        running = self.args.decode_workers
+        names, batch = [], []
+        while running:
+            item = self.decoded.get()
+            if item is _STOP:
+                running -= 1
+                continue
+            names.append(item[0])
+            batch.append(item[1])
+            if len(batch) == batch_size:
+                self.submit(names, batch)
+                count += len(batch)
+                names, batch = [], []
+                print('\r[*] {}/{} images, {:.2f} images/sec'.format(
+                    count, len(files), count / (time.time() - tic)), end=' ')
+        if batch:
+            self.submit(names, batch)
+            count += len(batch)
+
+        for _ in writers:
+            self.put_encoded(_STOP)
+        for t in writers:
+            t.join()
+        elapsed = time.time() - tic
+        print('\n[*] {} images in {:.1f}s, {:.2f} images/sec, {} failed'.format(
+            count, elapsed, count / max(elapsed, 1e-6), len(self.errors)))
+        return count
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    files = list_inputs(args.input)
+    print('[*] {} images from {}'.format(len(files), args.input))
+    G = load_generator(args.ckpt, args.device)
+    InferencePipeline(G, args).run(files)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,10 +1,15 @@
 import os
+import functools
 import torch
 import numpy as np
 from PIL import Image
 from torch.utils.data import Dataset
 from torch.utils.data import DataLoader
 from torchvision import transforms
+import distributed
+from data.cache import decode_image, image_size, build_image_cache
+from data.packed import PackedRainHazeDataset
+from data.augment import build_batch_augment
 
 
 # 返回 训练和测试数据集
@@ -23,42 +28,107 @@ class HaruLoader:
         # torch内的类
         train_dir = r'E:\研究生\MyData\filelists'
         val_dir = r'E:\研究生\MyData\filelists'
+        cache = build_image_cache(self.args)
+        # 批量数据增强, 见 data/augment.py; 训练集此时只返回 uint8 裁剪块, 转 float / 噪声 / 增强都在 batch 上做
+        batch_augment = build_batch_augment(self.args)
+        # 打包好的数据集见 data/packed.py
+        packed = self.args and (self.args.get('data') or {}).get('packed')
         if self.mode == 'train':
-            dataset = RainHazeImageDataset(train_dir, 'train',
-                                           transform=transforms.Compose([ToTensor()]))
+            if packed:
+                dataset = PackedRainHazeDataset(train_dir, 'train',
+                                                transform=transforms.Compose([ToTensor()]),
+                                                batch_augment=batch_augment is not None)
+            else:
+                dataset = RainHazeImageDataset(train_dir, 'train',
+                                               transform=transforms.Compose([ToTensor()]),
+                                               cache=cache,
+                                               batch_augment=batch_augment is not None)
             shuff = True
         elif self.mode == 'val':
-            dataset = RainHazeImageDataset(val_dir, 'val',
-                                           transform=transforms.Compose([ToTensor()]))
+            if packed:
+                dataset = PackedRainHazeDataset(val_dir, 'val',
+                                                transform=transforms.Compose([ToTensor()]))
+            else:
+                dataset = RainHazeImageDataset(val_dir, 'val',
+                                               transform=transforms.Compose([ToTensor()]),
+                                               cache=cache)
             shuff = False
         else:
             dataset = None
             shuff = False
             print('Undefined mode', self.mode)
             exit()
+        kwargs = loader_kwargs(self.args)
+        # 批量数据增强在 worker 里做时作为 collate_fn, 按数据集的 aug 决定是否裁剪/翻转/颜色扰动
+        if self.mode == 'train' and batch_augment is not None and not batch_augment.on_device:
+            kwargs['collate_fn'] = functools.partial(batch_augment.collate, aug=dataset.aug)
+        # 多进程训练时每个进程只读自己的那一份, 见 distributed.py
+        sampler = distributed.distributed_sampler(dataset, shuff)
         data_loader = DataLoader(dataset,
-                                 batch_size=1,
-                                 shuffle=shuff,
+                                 shuffle=shuff and sampler is None,
+                                 sampler=sampler,
                                  drop_last=True,
-                                 num_workers=0)
+                                 **kwargs)
         self.data_loader = data_loader
         return self.data_loader
 
 
+def worker_init_fn(worker_id):
+    # torch seeds every worker with base_seed + worker_id, reuse it so that the
+    # np.random augmentation differs between workers but replays with the seed
+    np.random.seed(torch.initial_seed() % 2 ** 32)
+
+
+def loader_kwargs(config, batch_size=None, epoch=0):
+    """
+    DataLoader arguments from the train: section of application.yml
+    :param config: application.yml as a dict, None for the single-threaded defaults
+    :param batch_size: overrides train: batch_size
+    :param epoch: added to train: seed, a loader rebuilt every epoch gets a new but reproducible order
+    :return: dict of keyword arguments for torch.utils.data.DataLoader
+    """
+    cfg = ((config or {}).get('train') or {})
+    num_workers = cfg.get('num_workers')
+    if num_workers is None:
+        num_workers = 0
+    elif num_workers < 0:
+        num_workers = os.cpu_count()
+    kwargs = {'batch_size': batch_size or cfg.get('batch_size') or 1,
+              'num_workers': num_workers,
+              'pin_memory': bool(cfg.get('pin_memory')) and torch.cuda.is_available()}
+    if num_workers > 0:
+        kwargs['worker_init_fn'] = worker_init_fn
+        kwargs['persistent_workers'] = bool(cfg.get('persistent_workers'))
+        if cfg.get('prefetch_factor'):
+            kwargs['prefetch_factor'] = cfg['prefetch_factor']
+    seed = cfg.get('seed')
+    if seed is not None:
+        # fixes the shuffle order and, through worker_init_fn, the worker seeds
+        kwargs['generator'] = torch.Generator().manual_seed(seed + epoch)
+        if num_workers == 0:
+            np.random.seed(seed + epoch)
+    return kwargs
+
+
 # set up
 class RainHazeImageDataset(Dataset):
-    def __init__(self, root_dir, mode, aug=False, transform=None):
+    def __init__(self, root_dir, mode, aug=False, transform=None, cache=None, batch_augment=False):
         """
         At __init__ state, we read in all the image paths of the entire dataset instead of image data
         :param root_dir: directory of files containing the paths to all rain images
         :param mode: 'train', 'val', or 'test'
         :param aug: Whether augment the input image
         :param transform:
+        :param cache: ImageCache shared by all reads, see data/cache.py
+        :param batch_augment: return the uint8 crops, the float conversion, noise and augment
+                              are done per batch by data/augment.BatchAugment
         """
         self.root_dir = root_dir
         self.mode = mode
         self.aug = aug
         self.transform = transform
+        self.cache = cache
+        self.batch_augment = batch_augment
         self.path = os.path.join(self.root_dir, (mode + '_s_rain.txt'))
         self.in_list = generate_new_seq(os.path.join(self.root_dir, (mode + '_in.txt')))
         self.real_list = generate_new_seq(os.path.join(self.root_dir, (mode + '_real.txt')))
@@ -78,23 +148,32 @@ class RainHazeImageDataset(Dataset):
             noise_trigger = False
 
         real_rain_index = np.random.randint(self.no_realrain)
-        rain = read_image(self.in_list[idx], noise_trigger)
-        im_gt = read_image(self.clean_list[idx])  # clean image = input - sparse - middle - dense
-        st_gt = read_image(self.streak_list[idx])  # sparse streak
-        trans_gt = read_image(self.trans_list[idx])  # middle streak
-        atm_gt = read_image(self.atm_list[idx])  # dense streak
-        realrain = read_image(self.real_list[real_rain_index])
+        # pick the crop windows first, only the crops are converted to float and noised
+        crop_size = 224 if self.aug else 256
+        box = random_crop_box(*image_size(self.in_list[idx], self.cache), size=crop_size)
+        real_box = random_crop_box(*image_size(self.real_list[real_rain_index], self.cache), size=crop_size)
+        if self.batch_augment:
+            rain = read_crop(self.in_list[idx], self.cache, box)
+            im_gt = read_crop(self.clean_list[idx], self.cache, box)
+            st_gt = read_crop(self.streak_list[idx], self.cache, box)
+            trans_gt = read_crop(self.trans_list[idx], self.cache, box)
+            atm_gt = read_crop(self.atm_list[idx], self.cache, box)
+            realrain = read_crop(self.real_list[real_rain_index], self.cache, real_box)
+        else:
+            rain = read_image(self.in_list[idx], noise_trigger, self.cache, box)
+            im_gt = read_image(self.clean_list[idx], cache=self.cache, box=box)  # clean image = input - sparse - middle - dense
+            st_gt = read_image(self.streak_list[idx], cache=self.cache, box=box)  # sparse streak
+            trans_gt = read_image(self.trans_list[idx], cache=self.cache, box=box)  # middle streak
+            atm_gt = read_image(self.atm_list[idx], cache=self.cache, box=box)  # dense streak
+            realrain = read_image(self.real_list[real_rain_index], cache=self.cache, box=real_box)
 
         # render haze
         if np.min(trans_gt) == 0:
             print(self.trans_list[idx])
 
         input_list = [rain, st_gt, trans_gt, atm_gt, im_gt, realrain]
-        if self.aug:
-            input_list = augment(input_list)
-        else:
-            # input_list = ImageResize(input_list, size=256)
-            input_list = RandomCrop(input_list, size=256)
+        if self.aug and not self.batch_augment:
+            input_list = augment(input_list, crop_size=None)
 
         if self.transform:
             input_list = self.transform(input_list)
@@ -290,20 +369,24 @@ def write_image(img, path):
         img_file.save(path)
 
 
-def read_image(image_path, noise=False):
+def read_image(image_path, noise=False, cache=None, box=None):
     """
     function: read image function
     :param image_path: input image path
     :param noise: whether apply noise on image
+    :param cache: ImageCache consulted before decoding, None to always decode
+    :param box: (row, col, height, width) window to keep, see random_crop_box.
+                Only this window is converted to float and noised
     :return: image in numpy array, range [0,1]
     """
-    img_file = Image.open(image_path)
-    img_data = np.array(img_file, dtype=np.float32)
+    img_data = decode_image(image_path, cache)
     (h, w, c) = img_data.shape
     if h < 224 or w < 224:
         img_data = np.array(Image.fromarray(img_data).resize(h, w))
-    if len(img_data.shape) < 3:
-        img_data = np.dstack((img_data, img_data, img_data))
+    if box is not None:
+        row, col, height, width = box
+        img_data = img_data[row:row + height, col:col + width]
+    img_data = img_data.astype(np.float32)
     if noise:
         (h, w, c) = img_data.shape
         noise = np.random.normal(0, 1, [h, w])
@@ -315,11 +398,37 @@ def read_image(image_path, noise=False):
     return img_data.astype(np.float32)
 
 
+def read_crop(image_path, cache=None, box=None):
+    """
+    function: uint8 window of an image, for data/augment.BatchAugment
+    :param image_path: input image path
+    :param cache: ImageCache consulted before decoding, None to always decode
+    :param box: (row, col, height, width) window to keep, see random_crop_box
+    :return: writable uint8 copy of the window, H x W x C
+    """
+    img_data = decode_image(image_path, cache)
+    if box is not None:
+        row, col, height, width = box
+        img_data = img_data[row:row + height, col:col + width]
+    return np.array(img_data, dtype=np.uint8)
+
+
+def random_crop_box(h, w, size=224):
+    """
+    function: draw the window RandomCrop would cut out of an h x w image
+    :return: (row, col, size, size)
+    """
+    row = np.random.randint(h - size)
+    col = np.random.randint(w - size)
+    return row, col, size, size
+
+
 def augment(input_list, scale_limit=300, crop_size=224):
     input_list = RandomHorizontalFlip(input_list)
     input_list = RandomColorWarp(input_list)
     # input_list = RandomScale(rain, streak, clean, size_limit=scale_limit)
-    input_list = RandomCrop(input_list, size=crop_size)
+    if crop_size:
+        input_list = RandomCrop(input_list, size=crop_size)
     return input_list
 
 
@@ -491,6 +600,9 @@ class AverageMeter(object):
         self.count = 0
 
     def update(self, val, n=1):
+        if torch.is_tensor(val):
+            # do not keep the autograd graph of val alive
+            val = val.detach()
         self.val = val
         self.sum += val * n
         self.count += n
@@ -514,18 +626,23 @@ def ImageResize(input_list, size=256):
 
 
 class RainHazeImageDataset(Dataset):
-    def __init__(self, root_dir, mode, aug=False, transform=None):
+    def __init__(self, root_dir, mode, aug=False, transform=None, cache=None, batch_augment=False):
         """
         At __init__ state, we read in all the image paths of the entire dataset instead of image data
         :param root_dir: directory of files containing the paths to all rain images
         :param mode: 'train', 'val', or 'test'
         :param aug: Whether augment the input image
         :param transform:
+        :param cache: ImageCache shared by all reads, see data/cache.py
+        :param batch_augment: return the uint8 crops, the float conversion, noise and augment
+                              are done per batch by data/augment.BatchAugment
         """
         self.root_dir = root_dir
         self.mode = mode
         self.aug = aug
         self.transform = transform
+        self.cache = cache
+        self.batch_augment = batch_augment
         self.path = os.path.join(self.root_dir, (mode + '_s_rain.txt'))
         self.in_list = generate_new_seq(os.path.join(self.root_dir, (mode + '_in.txt')))
         self.real_list = generate_new_seq(os.path.join(self.root_dir, (mode + '_real.txt')))
@@ -545,23 +662,32 @@ class RainHazeImageDataset(Dataset):
             noise_trigger = False
 
         real_rain_index = np.random.randint(self.no_realrain)
-        rain = read_image(self.in_list[idx], noise_trigger)
-        im_gt = read_image(self.clean_list[idx])  # clean image = input - sparse - middle - dense
-        st_gt = read_image(self.streak_list[idx])  # sparse streak
-        trans_gt = read_image(self.trans_list[idx])  # middle streak
-        atm_gt = read_image(self.atm_list[idx])  # dense streak
-        realrain = read_image(self.real_list[real_rain_index])
+        # pick the crop windows first, only the crops are converted to float and noised
+        crop_size = 224 if self.aug else 256
+        box = random_crop_box(*image_size(self.in_list[idx], self.cache), size=crop_size)
+        real_box = random_crop_box(*image_size(self.real_list[real_rain_index], self.cache), size=crop_size)
+        if self.batch_augment:
+            rain = read_crop(self.in_list[idx], self.cache, box)
+            im_gt = read_crop(self.clean_list[idx], self.cache, box)
+            st_gt = read_crop(self.streak_list[idx], self.cache, box)
+            trans_gt = read_crop(self.trans_list[idx], self.cache, box)
+            atm_gt = read_crop(self.atm_list[idx], self.cache, box)
+            realrain = read_crop(self.real_list[real_rain_index], self.cache, real_box)
+        else:
+            rain = read_image(self.in_list[idx], noise_trigger, self.cache, box)
+            im_gt = read_image(self.clean_list[idx], cache=self.cache, box=box)  # clean image = input - sparse - middle - dense
+            st_gt = read_image(self.streak_list[idx], cache=self.cache, box=box)  # sparse streak
+            trans_gt = read_image(self.trans_list[idx], cache=self.cache, box=box)  # middle streak
+            atm_gt = read_image(self.atm_list[idx], cache=self.cache, box=box)  # dense streak
+            realrain = read_image(self.real_list[real_rain_index], cache=self.cache, box=real_box)
 
         # render haze
         if np.min(trans_gt) == 0:
             print(self.trans_list[idx])
 
         input_list = [rain, st_gt, trans_gt, atm_gt, im_gt, realrain]
-        if self.aug:
-            input_list = augment(input_list)
-        else:
-            # input_list = ImageResize(input_list, size=256)
-            input_list = RandomCrop(input_list, size=256)
+        if self.aug and not self.batch_augment:
+            input_list = augment(input_list, crop_size=None)
 
         if self.transform:
             input_list = self.transform(input_list)
@@ -757,20 +883,24 @@ def write_image(img, path):
         img_file.save(path)
 
 
-def read_image(image_path, noise=False):
+def read_image(image_path, noise=False, cache=None, box=None):
     """
     function: read image function
     :param image_path: input image path
     :param noise: whether apply noise on image
+    :param cache: ImageCache consulted before decoding, None to always decode
+    :param box: (row, col, height, width) window to keep, see random_crop_box.
+                Only this window is converted to float and noised
     :return: image in numpy array, range [0,1]
     """
-    img_file = Image.open(image_path)
-    img_data = np.array(img_file, dtype=np.float32)
+    img_data = decode_image(image_path, cache)
     (h, w, c) = img_data.shape
     if h < 224 or w < 224:
         img_data = np.array(Image.fromarray(img_data).resize(h, w))
-    if len(img_data.shape) < 3:
-        img_data = np.dstack((img_data, img_data, img_data))
+    if box is not None:
+        row, col, height, width = box
+        img_data = img_data[row:row + height, col:col + width]
+    img_data = img_data.astype(np.float32)
     if noise:
         (h, w, c) = img_data.shape
         noise = np.random.normal(0, 1, [h, w])
@@ -782,11 +912,37 @@ def read_image(image_path, noise=False):
     return img_data.astype(np.float32)
 
 
+def read_crop(image_path, cache=None, box=None):
+    """
+    function: uint8 window of an image, for data/augment.BatchAugment
+    :param image_path: input image path
+    :param cache: ImageCache consulted before decoding, None to always decode
+    :param box: (row, col, height, width) window to keep, see random_crop_box
+    :return: writable uint8 copy of the window, H x W x C
+    """
+    img_data = decode_image(image_path, cache)
+    if box is not None:
+        row, col, height, width = box
+        img_data = img_data[row:row + height, col:col + width]
+    return np.array(img_data, dtype=np.uint8)
+
+
+def random_crop_box(h, w, size=224):
+    """
+    function: draw the window RandomCrop would cut out of an h x w image
+    :return: (row, col, size, size)
+    """
+    row = np.random.randint(h - size)
+    col = np.random.randint(w - size)
+    return row, col, size, size
+
+
 def augment(input_list, scale_limit=300, crop_size=224):
     input_list = RandomHorizontalFlip(input_list)
     input_list = RandomColorWarp(input_list)
     # input_list = RandomScale(rain, streak, clean, size_limit=scale_limit)
-    input_list = RandomCrop(input_list, size=crop_size)
+    if crop_size:
+        input_list = RandomCrop(input_list, size=crop_size)
     return input_list
 
 
@@ -958,6 +1114,9 @@ class AverageMeter(object):
         self.count = 0
 
     def update(self, val, n=1):
+        if torch.is_tensor(val):
+            # do not keep the autograd graph of val alive
+            val = val.detach()
         self.val = val
         self.sum += val * n
         self.count += n
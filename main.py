@@ -1,10 +1,13 @@
 import yaml
 import os
+import sys
 from data import *
 from model import *
 from torchvision import transforms
 from torch.utils.data import DataLoader
 from Haru import Haru
+from loader import loader_kwargs
+import distributed
 import json
 
 
@@ -27,7 +30,7 @@ def main():
     print(type(d))
 
 
-def load_data(mode, aug=False):
+def load_data(mode, aug=False, config=None):
     # 多种类型的数据集的类供用户选择   只做这个
     # transforms
     # 路径
@@ -51,10 +54,9 @@ def load_data(mode, aug=False):
         print('Undefined mode', mode)
         exit()
     data_loader = DataLoader(dataset,
-                             batch_size=1,
                              shuffle=shuff,
                              drop_last=True,
-                             num_workers=0)
+                             **loader_kwargs(config))
     return data_loader
 
 
@@ -75,7 +77,32 @@ def train_model():
     print("hello world")
 
 
+def run_haru(rank, world_size, config):
+    # 每个训练进程的入口, 见 distributed.launch
+    Haru(config).test()
+
+
 if __name__ == '__main__':
+    # haru infer: python main.py infer --ckpt ... --input ... (见 infer.py)
+    if len(sys.argv) > 1 and sys.argv[1] == 'infer':
+        from infer import main as infer_main
+        infer_main(sys.argv[2:])
+        sys.exit(0)
+    # haru export: python main.py export --ckpt ... --output ... (见 export.py, 服务端加载见 serving.py)
+    if len(sys.argv) > 1 and sys.argv[1] == 'export':
+        from export import main as export_main
+        export_main(sys.argv[2:])
+        sys.exit(0)
+    # haru optimize: python main.py optimize --ckpt ... [--export ...] (见 optimize.py)
+    if len(sys.argv) > 1 and sys.argv[1] == 'optimize':
+        from optimize import main as optimize_main
+        optimize_main(sys.argv[2:])
+        sys.exit(0)
+    # haru quantize: python main.py quantize --ckpt ... --data_root ... [--output ...] (见 quantize.py)
+    if len(sys.argv) > 1 and sys.argv[1] == 'quantize':
+        from quantize import main as quantize_main
+        quantize_main(sys.argv[2:])
+        sys.exit(0)
     # 获取当前脚本所在文件夹路径
     curPath = os.path.dirname(os.path.realpath(__file__))
     # 获取yaml文件路径
@@ -88,4 +115,8 @@ if __name__ == '__main__':
     config = yaml.safe_load(cfg)  # 用load方法转字典
     print(config)
     print(type(config))
-    app = Haru(config).test()
+    dist_cfg = (config.get('train') or {}).get('distributed') or {}
+    distributed.launch(run_haru, dist_cfg.get('world_size') or 1, args=(config,),
+                       backend=dist_cfg.get('backend') or 'gloo',
+                       master_addr=dist_cfg.get('master_addr') or '127.0.0.1',
+                       master_port=dist_cfg.get('master_port') or 29500)
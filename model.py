@@ -1,3 +1,5 @@
+from typing import List
+
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -22,7 +24,7 @@ class DecompModel(nn.Module):
         self.eps_list = [0.001, 0.0001]
         self.ref = RefUNet(3, 3)
         self.eps = 0.001
-        self.gf = None
+        self.gf = MultiGuidedFilter(self.radiux, self.eps_list)
         self.relu = nn.ReLU()
         self.tanh = nn.Tanh()
 
@@ -31,65 +33,166 @@ class DecompModel(nn.Module):
         trans, atm, A = self.fognet(torch.cat([x, lf], dim=1))
         streak = self.rainnet(torch.cat([x, hf], dim=1))
         streak = streak.repeat(1, 3, 1, 1)
-        dehaze = (x - (1 - trans) * atm) / (trans + self.eps) - streak
+        dehaze = self.dehaze(x, trans, atm, streak)
         clean = self.relu(self.ref(dehaze, A))
-        return streak, trans, atm, clean  # trans, atm, clean
+        return streak.float(), trans.float(), atm.float(), clean.float()  # trans, atm, clean
 
-    def forward_test(self, x, A, mode='A'):
-        if mode=='run':
+    def forward_test(self, x, A, mode='A', tile=None, overlap=64, tile_batch=4):
+        if mode=='run' and tile:
+            return self.forward_tiled(x, A, tile, overlap, tile_batch)
+        elif mode=='run':
             lf, hf = self.decomposition(x)
             trans, atm, _ = self.fognet(torch.cat([x, lf], dim=1))
             streak = self.rainnet(torch.cat([x, hf], dim=1))
             streak = streak.repeat(1, 3, 1, 1)
             #dehaze = (x - 0.7*streak - (1 - trans) * atm) / (trans + self.eps)
-            dehaze = (x - (1 - trans) * atm) / (trans + self.eps) - streak
+            dehaze = self.dehaze(x, trans, atm, streak)
             clean = self.relu(self.ref(dehaze, A))
-            return streak, trans, atm, clean  # trans, atm, clean
+            return streak.float(), trans.float(), atm.float(), clean.float()  # trans, atm, clean
         else:
             Amean = self.predict_atm(x)
             return Amean
 
-    def predict_atm(self, x):
-        _, c, h, w = x.size()
+    def forward_tiled(self, x, A, tile=512, overlap=64, tile_batch=4):
+        """
+        forward_test(mode='run') on overlapping tiles of an arbitrarily large x.
+        Tiles are tile x tile (a multiple of 64, the RefUNet constraint), run
+        tile_batch at a time and stitched with weights that fall off linearly
+        over the overlap. All tiles use the global A (see predict_atm), for the
+        dehaze formula, the RefUNet and the returned atm alike. Images smaller
+        than a tile are reflect-padded to a multiple of 64.
+        :param A: b x 3 x 1 x 1
+        :return: streak, trans, atm, clean as forward_test
+        """
+        assert tile % 64 == 0 and 0 <= overlap < tile
+        b, c, h, w = x.size()
+        pad_h = max(tile, h) - h if h >= tile else (-h) % 64
+        pad_w = max(tile, w) - w if w >= tile else (-w) % 64
+        if pad_h or pad_w:
+            x = F.pad(x, (0, pad_w, 0, pad_h), mode='reflect')
+        _, _, ph, pw = x.size()
+        th = min(tile, ph)
+        tw = min(tile, pw)
+        starts_y = self.tile_starts(ph, th, overlap)
+        starts_x = self.tile_starts(pw, tw, overlap)
+        feather = self.feather(th, overlap, x).view(-1, 1) * self.feather(tw, overlap, x).view(1, -1)
+
+        streak = x.new_zeros(b, 1, ph, pw)
+        trans = x.new_zeros(b, 1, ph, pw)
+        clean = x.new_zeros(b, c, ph, pw)
+        weight = x.new_zeros(1, 1, ph, pw)
+        for y0 in starts_y:
+            for x0 in starts_x:
+                weight[:, :, y0:y0 + th, x0:x0 + tw] += feather
+        jobs = [(i, y0, x0) for i in range(b) for y0 in starts_y for x0 in starts_x]
+        for k in range(0, len(jobs), tile_batch):
+            batch = jobs[k:k + tile_batch]
+            tiles = torch.cat([x[i:i + 1, :, y0:y0 + th, x0:x0 + tw] for i, y0, x0 in batch], dim=0)
+            tile_A = torch.cat([A[i:i + 1] for i, _, _ in batch], dim=0)
+            tile_streak, tile_trans, tile_clean = self.run_tile(tiles, tile_A)
+            for n, (i, y0, x0) in enumerate(batch):
+                streak[i, :, y0:y0 + th, x0:x0 + tw] += tile_streak[n] * feather
+                trans[i, :, y0:y0 + th, x0:x0 + tw] += tile_trans[n] * feather
+                clean[i, :, y0:y0 + th, x0:x0 + tw] += tile_clean[n] * feather
+
+        streak = (streak / weight)[:, :, :h, :w].repeat(1, 3, 1, 1)
+        trans = (trans / weight)[:, :, :h, :w].repeat(1, 3, 1, 1)
+        clean = (clean / weight)[:, :, :h, :w]
+        atm = A.expand(b, 3, h, w)
+        return streak, trans, atm, clean
+
+    def run_tile(self, x, A):
+        # forward_test(mode='run') with a given A; streak and trans stay single channel
         lf, hf = self.decomposition(x)
-        sum_A = torch.zeros(1,3,1,1, dtype=torch.float32).cuda()
-        count = 0
+        trans = self.fognet.transmission(torch.cat([x, lf], dim=1))
+        streak = self.rainnet(torch.cat([x, hf], dim=1))
+        dehaze = self.dehaze(x, trans, A, streak)
+        clean = self.relu(self.ref(dehaze, A))
+        return streak.float(), trans.float(), clean.float()
+
+    def dehaze(self, x, trans, atm, streak):
+        # physics model in fp32 under autocast: 1 / (trans + eps) blows up bf16/fp16 rounding of thin haze
+        with torch.autocast(x.device.type, enabled=False):
+            return (x.float() - (1 - trans.float()) * atm.float()) / (trans.float() + self.eps) - streak.float()
+
+    @staticmethod
+    def tile_starts(size, tile, overlap):
+        # tiles step by tile - overlap, the last one is moved back to end at size
+        if size <= tile:
+            return [0]
+        starts = list(range(0, size - tile, tile - overlap))
+        starts.append(size - tile)
+        return starts
+
+    @staticmethod
+    def feather(size, overlap, x):
+        # blending weight along one axis of a tile: linear ramp over the overlap, never 0
+        ramp = torch.arange(size, dtype=x.dtype, device=x.device) + 0.5
+        if overlap == 0:
+            return torch.ones_like(ramp)
+        return torch.clamp(torch.min(ramp, size - ramp) / overlap, max=1.0)
+
+    def predict_atm(self, x, tile_batch=64):
+        """
+        Weighted mean of the A estimated on every 256x256 tile of x.
+        Each tile is decomposed on its own window, the tile plus atm_margin()
+        pixels of context clipped to the image, which gives the lf of the whole
+        frame exactly; only tile_batch tiles are held at a time, so memory does
+        not grow with the image. The last row/column of tiles is shifted inside
+        the image and weighted by the number of rows / columns it adds, as before.
+        :return: b x 3 x 1 x 1
+        """
+        b, c, h, w = x.size()
         ph = 256
         pw = 256
-        rows = int(np.ceil(float(h)/float(ph)))
-        cols = int(np.ceil(float(w)/float(pw)))
-        for i in range(rows):
-            for j in range(cols):
-                ratey = 1
-                ratex = 1
-                if (i+1)*256 > h:
-                    dy = h - 256
-                    ratey = h - i*256
-                else:
-                    dy = i * 256
-                if (j+1) * 256 > w:
-                    dx = w - 256
-                    ratex = w - j*256
-                else:
-                    dx = j * 256
-                _, _, A = self.fognet(torch.cat([x, lf], dim=1), dx, dy)
-                sum_A = sum_A + A * ratey * ratex
-                count+=1 * ratey * ratex
-        return sum_A/count
+        margin = self.atm_margin()
+        offsets_y, rates_y = self.tile_offsets(h, ph)
+        offsets_x, rates_x = self.tile_offsets(w, pw)
+        # image-major, like the rows of A below
+        jobs = [(i, y0, x0) for i in range(b) for y0 in offsets_y for x0 in offsets_x]
+        A = []
+        for k in range(0, len(jobs), tile_batch):
+            tiles = []
+            for i, y0, x0 in jobs[k:k + tile_batch]:
+                top = max(y0 - margin, 0)
+                left = max(x0 - margin, 0)
+                window = x[i:i + 1, :, top:min(y0 + ph + margin, h), left:min(x0 + pw + margin, w)]
+                lf, _ = self.decomposition(window)
+                tile = torch.cat([window, lf], dim=1)
+                tiles.append(tile[:, :, y0 - top:y0 - top + ph, x0 - left:x0 - left + pw])
+            A.append(self.fognet.estimate_atm(torch.cat(tiles, dim=0)))
+        A = torch.cat(A, dim=0).view(b, len(offsets_y) * len(offsets_x), 3, 1, 1)
+        rate = torch.tensor(rates_y, dtype=A.dtype, device=A.device).view(-1, 1) * \
+            torch.tensor(rates_x, dtype=A.dtype, device=A.device).view(1, -1)
+        rate = rate.view(1, -1, 1, 1, 1)
+        return (A * rate).sum(dim=1) / rate.sum()
+
+    def atm_margin(self):
+        # the guided filter box-filters twice (statistics, then A and b): lf at a pixel
+        # depends on the input within 2 * max radius of it
+        return 2 * max(self.gf.radius_list)
+
+    @staticmethod
+    def tile_offsets(size, patch):
+        # tile starts along one axis; a partial last tile is moved back to size - patch
+        offsets = []
+        rates = []
+        for i in range((size + patch - 1) // patch):
+            if (i + 1) * patch > size:
+                offsets.append(size - patch)
+                rates.append(size - i * patch)
+            else:
+                offsets.append(i * patch)
+                rates.append(1)
+        return offsets, rates
 
     def decomposition(self, x):
-        LF_list = []
-        HF_list = []
-        res = get_residue(x)
-        res = res.repeat(1, 3, 1, 1)
-        for radius in self.radiux:
-            for eps in self.eps_list:
-                self.gf = GuidedFilter(radius, eps)
-                LF = self.gf(res, x)
-                LF_list.append(LF)
-                HF_list.append(x - LF)
-        LF = torch.cat(LF_list, dim=1)
-        HF = torch.cat(HF_list, dim=1)
+        # guided filter of x by its residue for every radius and eps, see MultiGuidedFilter
+        # the box sums are cumsums over the whole image, they stay in fp32 under autocast
+        with torch.autocast(x.device.type, enabled=False):
+            x = x.float()
+            res = get_residue(x)
+            LF, HF = self.gf(res, x)
         return LF, HF
 
 
@@ -106,12 +209,20 @@ class FogNet(nn.Module):
     def forward(self, x, dx=0, dy=0):
         _, c, h, w = x.size()
 
-        A = self.relu(self.atmnet(self.atmconv1x1(x[:, :, dy:dy+256, dx:dx+256])))
+        A = self.estimate_atm(x[:, :, dy:dy+256, dx:dx+256])
         trans = self.relu(self.transnet(x))
         atm = A.repeat(1, 1, h, w)
         trans = trans.repeat(1, 3, 1, 1)
         return trans, atm, A
 
+    def transmission(self, x):
+        # trans branch alone, single channel
+        return self.relu(self.transnet(x))
+
+    def estimate_atm(self, x):
+        # A branch alone, x is a batch of 256x256 crops
+        return self.relu(self.atmnet(self.atmconv1x1(x)))
+
 
 class TransUNet(nn.Module):
     def __init__(self, in_channel, n_classes):
@@ -169,7 +280,7 @@ class GlobalLocalUnet(nn.Module):
         self.gdown5 = down(512, 512)  # 14x14  | 32x32  | 64x64
         self.gdown6 = down(512, 512)  # 7x7x512   | 16x16x512  | 32x32x512
         self.digest = nn.Conv2d(1024, 512, 1, 1, 0)
-        self.l1 = nn.Linear(self.image_size / 64 * self.image_size / 64 * 512, 512)
+        self.l1 = nn.Linear(self.image_size // 64 * self.image_size // 64 * 512, 512)
         self.relu = nn.ReLU()
 
     def forward(self, x):
@@ -186,7 +297,7 @@ class GlobalLocalUnet(nn.Module):
         gx6 = self.gdown6(gx5)
         gx6vec = gx6.view(gx6.size(0), -1)
         gx7vec = self.relu(self.l1(gx6vec))
-        gx7conv = gx7vec.view(gx7vec.size(0), -1, 1, 1).repeat(1, 1, self.image_size / 32, self.image_size / 32)
+        gx7conv = gx7vec.view(gx7vec.size(0), -1, 1, 1).repeat(1, 1, self.image_size // 32, self.image_size // 32)
 
         # decoder
         u0 = torch.cat((lx5, gx7conv), dim=1)
@@ -223,7 +334,7 @@ class RefUNet(nn.Module):
     def forward(self, x, A):
         input_img = x
         _, c, h, w = x.size()
-        A1 = A.repeat(1, 1, h/64, w/64)
+        A1 = A.repeat(1, 1, h // 64, w // 64)
         A2 = self.Aup1(A1)  # 4x4
         A3 = self.Aup2(A2)  # 8x8 A3=16x16
         # A4 = self.Aup3(A3) # 16x16 A4=16x16
@@ -373,9 +484,9 @@ class ResidualBlockStraight(nn.Module):
     def __init__(self, in_channels, out_channels, dilation=1, last=False):
         super(ResidualBlockStraight, self).__init__()
         assert (in_channels == out_channels)
-        self.conv1 = res_conv(in_channels, out_channels / 4, dil=dilation)
-        self.conv2 = res_conv(out_channels / 4, out_channels / 4)
-        self.conv3 = res_conv(out_channels / 4, out_channels)
+        self.conv1 = res_conv(in_channels, out_channels // 4, dil=dilation)
+        self.conv2 = res_conv(out_channels // 4, out_channels // 4)
+        self.conv3 = res_conv(out_channels // 4, out_channels)
         self.relu = nn.ReLU(inplace=True)
         self.tanh = nn.Tanh()
         self.last = last
@@ -399,9 +510,9 @@ class ResidualBlockDown(nn.Module):
     def __init__(self, in_channels, out_channels, dilation=1, last=True):
         super(ResidualBlockDown, self).__init__()
         self.conv1 = res_conv(in_channels, in_channels, dil=dilation)
-        self.conv2 = res_conv(in_channels, in_channels / 2)
-        self.conv3 = res_conv(in_channels / 2, in_channels / 4)
-        self.conv_out = nn.Conv2d(in_channels + in_channels / 4, out_channels, 3, 1, 1)
+        self.conv2 = res_conv(in_channels, in_channels // 2)
+        self.conv3 = res_conv(in_channels // 2, in_channels // 4)
+        self.conv_out = nn.Conv2d(in_channels + in_channels // 4, out_channels, 3, 1, 1)
         self.relu = nn.ReLU(inplace=True)
         self.tanh = nn.Tanh()
         self.last = last
@@ -426,11 +537,11 @@ class ResidualBlockDown(nn.Module):
 class ResidualBlockUp(nn.Module):
     def __init__(self, in_channels, out_channels, last=False):
         super(ResidualBlockUp, self).__init__()
-        self.conv0 = nn.Conv2d(in_channels, out_channels / 4, kernel_size=5, stride=1, padding=2)
-        self.conv1 = res_conv(out_channels / 4, out_channels / 4)
-        self.conv2 = res_conv(out_channels / 4, out_channels / 4)
-        self.conv3 = res_conv(out_channels / 4, out_channels)
-        self.conv_in = nn.Conv2d(out_channels / 4, out_channels, 3, 1, 1)
+        self.conv0 = nn.Conv2d(in_channels, out_channels // 4, kernel_size=5, stride=1, padding=2)
+        self.conv1 = res_conv(out_channels // 4, out_channels // 4)
+        self.conv2 = res_conv(out_channels // 4, out_channels // 4)
+        self.conv3 = res_conv(out_channels // 4, out_channels)
+        self.conv_in = nn.Conv2d(out_channels // 4, out_channels, 3, 1, 1)
         self.relu = nn.ReLU(inplace=True)
         self.tanh = nn.Tanh()
         self.last = last
@@ -470,6 +581,90 @@ def res_conv(in_ch, out_ch, k=3, s=1, dil=1, bias=True):
     return nn.Conv2d(in_ch, out_ch, kernel_size=k, stride=s, dilation=dil, padding=1, bias=bias)
 
 
+def box_diff(x, r, dim):
+    # type: (Tensor, int, int) -> Tensor
+    # diff_x / diff_y of guided_filter_pytorch along dim: window sums of radius r from a cumsum
+    n = x.size(dim)
+    left = x.narrow(dim, r, r + 1)
+    middle = x.narrow(dim, 2 * r + 1, n - 2 * r - 1) - x.narrow(dim, 0, n - 2 * r - 1)
+    right = x.narrow(dim, n - 1, 1) - x.narrow(dim, n - 2 * r - 1, r)
+    return torch.cat([left, middle, right], dim=dim)
+
+
+class MultiGuidedFilter(nn.Module):
+    """
+    GuidedFilter(radius, eps)(guide, x) for every radius and eps at once.
+
+    The box filters of all radii share one cumsum per axis: the statistics of
+    guide and x are cumsummed along H once, cut into window sums for every
+    radius, then cumsummed along W together. A and b of all (radius, eps) pairs
+    go through the same two cumsums in a second pass. The result matches
+    concatenating GuidedFilter(radius, eps)(guide, x) in radius-major order.
+    """
+
+    def __init__(self, radius_list, eps_list):
+        super(MultiGuidedFilter, self).__init__()
+        self.radius_list = list(radius_list)
+        self.eps_list = list(eps_list)
+
+    def box_filter(self, x, radius_list, shared=False):
+        # type: (Tensor, List[int], bool) -> Tensor
+        # x holds len(radius_list) equal channel groups, group k is filtered with radius_list[k];
+        # shared: x is a single group filtered with every radius
+        if shared:
+            groups = [x.cumsum(dim=2)] * len(radius_list)
+        else:
+            groups = x.cumsum(dim=2).chunk(len(radius_list), dim=1)
+        x = torch.cat([box_diff(g, r, 2) for g, r in zip(groups, radius_list)], dim=1)
+        groups = x.cumsum(dim=3).chunk(len(radius_list), dim=1)
+        return torch.cat([box_diff(g, r, 3) for g, r in zip(groups, radius_list)], dim=1)
+
+    def window_size(self, r, h, w, x):
+        # type: (int, int, int, Tensor) -> Tensor
+        # box filter of ones, i.e. the number of pixels in every clipped window
+        rows = torch.arange(h, dtype=x.dtype, device=x.device)
+        cols = torch.arange(w, dtype=x.dtype, device=x.device)
+        rows = torch.clamp(rows + r, max=h - 1) - torch.clamp(rows - r, min=0) + 1
+        cols = torch.clamp(cols + r, max=w - 1) - torch.clamp(cols - r, min=0) + 1
+        return (rows.view(h, 1) * cols.view(1, w)).view(1, 1, h, w)
+
+    def forward(self, guide, x):
+        _, c, h, w = x.size()
+        gc = guide.size(1)
+        assert gc == 1 or gc == c
+        assert h > 2 * max(self.radius_list) + 1 and w > 2 * max(self.radius_list) + 1
+        n_radius = len(self.radius_list)
+        n_eps = len(self.eps_list)
+
+        stats = torch.cat([guide, x, guide * x, guide * guide], dim=1)
+        means = self.box_filter(stats, self.radius_list, shared=True)
+        N = [self.window_size(r, h, w, x) for r in self.radius_list]
+
+        # typed for torch.jit.script (export.py)
+        ab_list = torch.jit.annotate(List[torch.Tensor], [])
+        ab_radius = torch.jit.annotate(List[int], [])
+        for i, r in enumerate(self.radius_list):
+            mean_g, mean_x, mean_gx, mean_gg = torch.split(
+                means.narrow(1, i * stats.size(1), stats.size(1)) / N[i], [gc, c, c, gc], dim=1)
+            cov_gx = mean_gx - mean_g * mean_x
+            var_g = mean_gg - mean_g * mean_g
+            for eps in self.eps_list:
+                A = cov_gx / (var_g + eps)
+                b = mean_x - A * mean_g
+                ab_list.append(torch.cat([A, b], dim=1))
+                ab_radius.append(r)
+        mean_ab = self.box_filter(torch.cat(ab_list, dim=1), ab_radius)
+
+        LF_list = torch.jit.annotate(List[torch.Tensor], [])
+        for k, r in enumerate(ab_radius):
+            mean_A, mean_b = mean_ab.narrow(1, k * 2 * c, 2 * c).chunk(2, dim=1)
+            N_k = N[k // n_eps]
+            LF_list.append(mean_A / N_k * guide + mean_b / N_k)
+        LF = torch.cat(LF_list, dim=1)
+        HF = x.repeat(1, n_radius * n_eps, 1, 1) - LF
+        return LF, HF
+
+
 class SimpUnet(nn.Module):
     def __init__(self, num_classes, in_channels=3, depth=5,
                  start_filts=64, up_mode='transpose',
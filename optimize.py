@@ -0,0 +1,155 @@
+import sys
+import copy
+import time
+import argparse
+
+import torch
+import torch.nn as nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
+
+# 推理图优化: haru optimize
+# 1. 方阵 1x1 预卷积 (FogNet.atmconv1x1, TransUNet.conv1x1, RainNet.conv1x1) 合并进后面的卷积
+# 2. NLayerEstimator (atmnet) 的 BatchNorm 合并进前面的卷积 (eval 模式)
+# 3. --export 时导出 TorchScript 并由 torch.jit.optimize_for_inference 融合 conv+ReLU
+# python main.py optimize --ckpt ckpt/pretrained2.pth.tar --export out/haru_G_opt.pt
+
+
+class InputShift(nn.Module):
+    """
+    x - shift, what is left of a 1x1 conv folded into the next conv
+    (see fold_pre_conv): the shift keeps the zero padding of the next conv exact
+    """
+
+    def __init__(self, shift):
+        super(InputShift, self).__init__()
+        self.register_buffer('shift', shift.view(1, -1, 1, 1))
+
+    def forward(self, x):
+        return x - self.shift
+
+
+def fold_pre_conv(pre, conv, max_cond=1e6):
+    """
+    Fold a square 1x1 conv y = W1 x + b1 into the conv after it.
+    With the input shift p = -W1^-1 b1, W1 x + b1 = W1 (x - p), so
+    conv(pre(x)) = conv'(x - p) with conv' = conv o W1 and no bias from pre;
+    zero padding of x - p equals the zero padding of pre(x), the fold is exact at the borders too.
+    :return: (InputShift, folded conv), None if W1 is not safely invertible
+    """
+    w1 = pre.weight.detach().double().flatten(1)
+    b1 = pre.bias.detach().double() if pre.bias is not None else w1.new_zeros(w1.size(0))
+    if w1.size(0) != w1.size(1) or torch.linalg.cond(w1).item() > max_cond:
+        return None
+    shift = torch.linalg.solve(w1, -b1)
+    folded = nn.Conv2d(w1.size(1), conv.out_channels, conv.kernel_size, stride=conv.stride,
+                       padding=conv.padding, dilation=conv.dilation, groups=conv.groups,
+                       bias=True).to(conv.weight.device)
+    weight = torch.einsum('ocyx,ci->oiyx', conv.weight.detach().double(), w1)
+    bias = conv.bias.detach().double() if conv.bias is not None else weight.new_zeros(weight.size(0))
+    with torch.no_grad():
+        folded.weight.copy_(weight.to(conv.weight.dtype))
+        folded.bias.copy_(bias.to(conv.weight.dtype))
+    return InputShift(shift.to(conv.weight.dtype)), folded
+
+
+def fold_batchnorm(sequential):
+    """
+    Fold every Conv2d -> BatchNorm2d pair of an nn.Sequential (eval statistics)
+    :return: number of folded pairs
+    """
+    count = 0
+    for i in range(len(sequential) - 1):
+        conv, bn = sequential[i], sequential[i + 1]
+        if isinstance(conv, nn.Conv2d) and isinstance(bn, nn.BatchNorm2d):
+            sequential[i] = fuse_conv_bn_eval(conv, bn)
+            sequential[i + 1] = nn.Identity()
+            count += 1
+    return count
+
+
+def optimize(G):
+    """
+    Inference copy of a DecompModel with the 1x1 pre-convs and the atmnet BatchNorms folded.
+    The module structure is kept, export.py and forward_tiled work on the result.
+    :return: (optimized eval copy, list of the folds done / skipped)
+    """
+    G = copy.deepcopy(G).eval()
+    folds = []
+    fognet = G.fognet
+    atm_layers = fognet.atmnet.model
+    pre_convs = (('FogNet.atmconv1x1', fognet, 'atmconv1x1', atm_layers, 0),
+                 ('TransUNet.conv1x1', fognet.transnet, 'conv1x1', fognet.transnet.inc.conv.conv, 0),
+                 ('RainNet.conv1x1', G.rainnet, 'conv1x1', G.rainnet.block1, 'conv0'))
+    for name, owner, attr, parent, key in pre_convs:
+        conv = parent[key] if isinstance(key, int) else getattr(parent, key)
+        result = fold_pre_conv(getattr(owner, attr), conv)
+        if result is None:
+            folds.append(name + ' skipped (1x1 weight not invertible)')
+            continue
+        setattr(owner, attr, result[0])
+        if isinstance(key, int):
+            parent[key] = result[1]
+        else:
+            setattr(parent, key, result[1])
+        folds.append(name + ' folded')
+    folds.append('NLayerEstimator BatchNorm x{} folded'.format(fold_batchnorm(atm_layers)))
+    return G, folds
+
+
+def verify(G, optimized, image_size=512):
+    """
+    :return: dict of output name to max abs difference between G (eval) and optimized
+    """
+    G = G.eval()
+    x = torch.rand(1, 3, image_size, image_size)
+    report = {}
+    with torch.no_grad():
+        for name, a, b in zip(('streak', 'trans', 'atm', 'clean'), G(x), optimized(x)):
+            report[name] = (a - b).abs().max().item()
+        report['predict_atm'] = (G.predict_atm(x) - optimized.predict_atm(x)).abs().max().item()
+    return report
+
+
+def latency(model, image_size=512, runs=3):
+    x = torch.rand(1, 3, image_size, image_size)
+    with torch.no_grad():
+        model(x)
+        tic = time.time()
+        for _ in range(runs):
+            model(x)
+    return (time.time() - tic) / runs
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='haru optimize', description='Fold DecompModel for inference')
+    parser.add_argument('--ckpt', required=True, help='checkpoint with the generator weights (G)')
+    parser.add_argument('--export', default='', help='also write the optimized model as TorchScript')
+    parser.add_argument('--image_size', type=int, default=512, help='size of the verification image')
+    parser.add_argument('--runs', type=int, default=3, help='timed runs of the latency report, 0 to skip')
+    return parser
+
+
+def main(argv=None):
+    from infer import load_generator
+    import export
+    args = build_parser().parse_args(argv)
+    G = load_generator(args.ckpt, 'cpu')
+    optimized, folds = optimize(G)
+    for fold in folds:
+        print('[*] ' + fold)
+    for name, diff in verify(G, optimized, args.image_size).items():
+        print('{:<16}max abs diff {:.3e}'.format(name, diff))
+    if args.runs:
+        before = latency(G, args.image_size, args.runs)
+        after = latency(optimized, args.image_size, args.runs)
+        print('[*] {:.1f} ms -> {:.1f} ms per {}x{} image'.format(
+            before * 1000, after * 1000, args.image_size, args.image_size))
+    if args.export:
+        scripted = export.export(optimized, args.export, freeze=True, optimize=True)
+        print('[*] Exported {}'.format(args.export))
+        for name, diff in export.verify(G, scripted, args.image_size).items():
+            print('{:<16}max abs diff {:.3e}'.format(name, diff))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
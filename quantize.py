@@ -0,0 +1,179 @@
+import os
+import sys
+import copy
+import argparse
+import warnings
+
+import numpy as np
+import torch
+from skimage.transform import resize
+
+from data.helper import generate_new_seq, read_image, BatchMetrics
+from optimize import optimize, latency
+
+# int8 训练后量化 (PTQ): haru quantize
+# TransUNet / RainNet / RefUNet 的卷积主干做静态 int8 量化 (FX graph mode, conv+ReLU 融合, 逐通道权重;
+# 这些主干里没有 BatchNorm, double_conv 的 InstanceNorm 是注释掉的)
+# 引导滤波分解, atmnet (A 估计) 与去雾公式保持 fp32
+# 校准: <data_root>/<mode>_real.txt 真实雨图抽样; 最后在 val 列表上与 fp32 比较 PSNR / SSIM 和 CPU 延迟
+# python main.py quantize --ckpt ckpt/pretrained2.pth.tar --data_root data/list --output out/haru_G_int8.pt
+
+# (attribute path in DecompModel, channels of the example input)
+BACKBONES = (('fognet.transnet', 33), ('rainnet', 33), ('ref', 3))
+
+
+def default_backend():
+    # fbgemm kernels on x86, qnnpack on ARM boxes
+    engines = torch.backends.quantized.supported_engines
+    return 'x86' if 'x86' in engines else 'qnnpack'
+
+
+def get_module(model, path):
+    for name in path.split('.'):
+        model = getattr(model, name)
+    return model
+
+
+def set_module(model, path, module):
+    parent, _, name = path.rpartition('.')
+    setattr(get_module(model, parent) if parent else model, name, module)
+
+
+def example_inputs(channels, image_size):
+    x = torch.rand(1, channels, image_size, image_size)
+    # RefUNet also takes the 1x1 atmospheric light
+    return (x, torch.rand(1, 3, 1, 1)) if channels == 3 else (x,)
+
+
+def calibration_images(filelist, num=32, image_size=512, seed=0):
+    """
+    :param filelist: real rain filelist (<mode>_real.txt), see generate_new_seq
+    :param num: number of images drawn with a fixed seed, None or 0 for all
+    :return: list of 1 x 3 x S x S float tensors, resized like Haru.predict_resize
+    """
+    files = generate_new_seq(filelist)
+    if num and num < len(files):
+        files = [files[i] for i in sorted(np.random.RandomState(seed).choice(len(files), num, replace=False))]
+    images = []
+    for filename in files:
+        image = resize(read_image(filename, noise=False), [image_size, image_size])
+        images.append(torch.from_numpy(image.transpose(2, 0, 1)).float().unsqueeze(0))
+    return images
+
+
+def prepare(G, backend=None, image_size=256, fold=True):
+    """
+    Copy of G with observers inserted into the BACKBONES, ready for calibration
+    :param fold: start from optimize(G), the 1x1 pre-convs and atmnet BatchNorms folded
+    :return: prepared eval copy, G itself is not changed
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx
+    backend = backend or default_backend()
+    torch.backends.quantized.engine = backend
+    model = optimize(G)[0] if fold else copy.deepcopy(G).eval()
+    qconfig_mapping = get_default_qconfig_mapping(backend)
+    with warnings.catch_warnings():
+        # torch.ao.quantization is deprecated in favour of torchao (pt2e), still the CPU int8 path here
+        warnings.simplefilter('ignore')
+        for path, channels in BACKBONES:
+            set_module(model, path, prepare_fx(get_module(model, path), qconfig_mapping,
+                                               example_inputs(channels, image_size)))
+    return model
+
+
+def calibrate(model, images):
+    # the observers record the activation ranges of the whole forward, atmnet / A included
+    with torch.no_grad():
+        for image in images:
+            model(image)
+    return model
+
+
+def convert(model):
+    """
+    Replace the observed BACKBONES by their int8 modules, in place
+    """
+    from torch.ao.quantization.quantize_fx import convert_fx
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        for path, _ in BACKBONES:
+            set_module(model, path, convert_fx(get_module(model, path)))
+    return model
+
+
+def quantize(G, images, backend=None, fold=True):
+    """
+    Post-training static int8 quantization of the conv backbones of G
+    :param images: calibration batches, see calibration_images
+    :return: eval copy of G with int8 TransUNet / RainNet / RefUNet, fp32 elsewhere
+    """
+    size = images[0].size(2) if images else 256
+    return convert(calibrate(prepare(G, backend, size, fold), images))
+
+
+def compare(G, Q, store, batch_size=8):
+    """
+    PSNR / SSIM of the clean output of G (fp32) and Q (int8) against the ground truth of store,
+    and of Q against G
+    :param store: evaluator.ValidationStore
+    :return: dict of name to {'psnr', 'ssim'}
+    """
+    meters = {'fp32': BatchMetrics(ssim=True), 'int8': BatchMetrics(ssim=True),
+              'int8 vs fp32': BatchMetrics(ssim=True)}
+    G = G.eval()
+    with torch.no_grad():
+        for inputs in store.batches(batch_size):
+            clean = G(inputs[0])[3].clamp(0, 1)
+            clean_q = Q(inputs[0])[3].clamp(0, 1)
+            meters['fp32'].update(clean, inputs[4])
+            meters['int8'].update(clean_q, inputs[4])
+            meters['int8 vs fp32'].update(clean_q, clean)
+    return {name: meter.sync(reduce=False) for name, meter in meters.items()}
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='haru quantize', description='Int8 post-training quantization of DecompModel')
+    parser.add_argument('--ckpt', required=True, help='checkpoint with the generator weights (G)')
+    parser.add_argument('--data_root', required=True, help='directory of the <mode>_real.txt and val_*.txt filelists')
+    parser.add_argument('--calib_mode', default='train', help='calibrate on <calib_mode>_real.txt')
+    parser.add_argument('--calib_images', type=int, default=32, help='real rain images drawn for calibration')
+    parser.add_argument('--image_size', type=int, default=512, help='calibration and latency size, multiple of 64')
+    parser.add_argument('--backend', default=None, help='x86 / fbgemm / qnnpack, default by platform')
+    parser.add_argument('--no_fold', action='store_true', help='quantize without the folds of optimize.py')
+    parser.add_argument('--val_images', type=int, default=0, help='validation images compared, 0 for all')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--runs', type=int, default=3, help='timed runs of the latency report, 0 to skip')
+    parser.add_argument('--output', default='', help='also export the int8 model as TorchScript')
+    return parser
+
+
+def main(argv=None):
+    from infer import load_generator
+    from evaluator import ValidationStore
+    import export
+    args = build_parser().parse_args(argv)
+    G = load_generator(args.ckpt, 'cpu').eval()
+    images = calibration_images(os.path.join(args.data_root, args.calib_mode + '_real.txt'),
+                                args.calib_images, args.image_size)
+    print('[*] Calibrating on {} real rain images'.format(len(images)))
+    Q = quantize(G, images, args.backend, fold=not args.no_fold)
+
+    store = ValidationStore(args.data_root, 'val', max_images=args.val_images or None)
+    print('[*] Comparing on {} validation images'.format(len(store)))
+    for name, values in compare(G, Q, store, args.batch_size).items():
+        print('{:<16}PSNR {:.2f}  SSIM {:.4f}'.format(name, values['psnr'], values['ssim']))
+    if args.runs:
+        before = latency(G, args.image_size, args.runs)
+        after = latency(Q, args.image_size, args.runs)
+        print('[*] {:.1f} ms -> {:.1f} ms per {}x{} image ({:.2f}x)'.format(
+            before * 1000, after * 1000, args.image_size, args.image_size, before / after))
+    if args.output:
+        if os.path.dirname(args.output) and not os.path.exists(os.path.dirname(args.output)):
+            os.makedirs(os.path.dirname(args.output))
+        export.export(Q, args.output, freeze=True)
+        print('[*] Exported {}'.format(args.output))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,86 @@
+import sys
+import time
+import argparse
+
+import torch
+
+# 推理服务: 加载 export.py 导出的 TorchScript 模型, 只依赖 torch (不导入训练代码)
+# python serving.py out/haru_G.pt --image_size 512 --runs 10
+
+
+def load_model(path, device='cpu', threads=0):
+    """
+    :param path: TorchScript file written by export.py
+    :param threads: intra-op threads of this worker, 0 keeps the torch default
+    :return: ScriptModule with forward(x), run(x, A) and predict_atm(x)
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    model = torch.jit.load(path, map_location=device)
+    model.eval()
+    return model
+
+
+class HaruService(object):
+    """
+    Rain / haze removal of one or more images with an exported DecompModel.
+    Images are H x W x 3 uint8 arrays (numpy or tensor) or N x 3 x H x W float
+    tensors in [0, 1]; H and W must be multiples of 64.
+    """
+
+    OUTPUTS = ('streak', 'trans', 'atm', 'clean')
+
+    def __init__(self, path, device='cpu', threads=0, global_atm=False):
+        """
+        :param global_atm: refine with the image-wide A of predict_atm instead of the A
+                           of the top-left 256x256 crop
+        """
+        self.device = torch.device(device)
+        self.model = load_model(path, self.device, threads)
+        self.global_atm = global_atm
+
+    def to_input(self, image):
+        x = torch.as_tensor(image)
+        if x.dtype == torch.uint8:
+            x = x.permute(2, 0, 1).unsqueeze(0).float() / 255.0
+        return x.to(self.device)
+
+    def __call__(self, image):
+        """
+        :return: dict of output name to N x 3 x H x W float tensor in [0, 1] on the device
+        """
+        x = self.to_input(image)
+        with torch.no_grad():
+            if self.global_atm:
+                out = self.model.run(x, self.model.predict_atm(x))
+            else:
+                out = self.model(x)
+        return dict(zip(self.OUTPUTS, out))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='haru serving', description='Load an exported model and time it')
+    parser.add_argument('model', help='TorchScript file written by export.py')
+    parser.add_argument('--image_size', type=int, default=512)
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+    parser.add_argument('--global_atm', action='store_true')
+    parser.add_argument('--device', default='cuda' if torch.cuda.is_available() else 'cpu')
+    args = parser.parse_args(argv)
+
+    tic = time.time()
+    service = HaruService(args.model, args.device, args.threads, args.global_atm)
+    print('[*] Loaded {} in {:.2f}s'.format(args.model, time.time() - tic))
+    image = torch.randint(0, 256, (args.image_size, args.image_size, 3), dtype=torch.uint8)
+    # the first calls run the profiling passes of the TorchScript executor
+    for _ in range(2):
+        service(image)
+    tic = time.time()
+    for _ in range(args.runs):
+        service(image)
+    print('[*] {:.1f} ms per {}x{} image'.format((time.time() - tic) * 1000 / max(args.runs, 1),
+                                                 args.image_size, args.image_size))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
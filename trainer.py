@@ -1,18 +1,27 @@
 import os
 import math
+import contextlib
 from decimal import Decimal
 import time
 import utility
+import distributed
 
 import torch
 import torch.nn.utils as utils
 from tqdm import tqdm
 from torch.autograd import Variable
 from data.helper import *
-from tensorboard_logger import configure, log_value
+from tensorboard_logger import configure
 
 
 class HaruTrainer():
+    # progress bar fields (metric name, short name), see MetricsLogger.describe
+    STAGE1_FIELDS = (('train_loss', 'L'), ('streak_loss', 'sp'), ('trans_loss', 'tr'), ('atm_loss', 'atm'),
+                     ('clean_loss', 'im'), ('gradient_loss', 'gr'), ('train_acc', 'acc'))
+    STAGE2_FIELDS = (('gen_loss', 'L'), ('clean_loss', 'im'), ('G_adv_loss', 'adv'), ('gradient_loss', 'gr'),
+                     ('pc_loss', 'pc'), ('G_adv_realrain_loss', 'rain'), ('D_true_loss', 'tl'),
+                     ('D_fake_loss', 'fl'), ('dis_loss', 'prb'), ('acc', 'acc'))
+
     def __init__(self, data, loader, my_model, my_loss, ckp, args=None):
         # 肯定需要数据集，损失函数，模型,权重，lr的调整
         self.args = args
@@ -32,42 +41,57 @@ class HaruTrainer():
         self.error_last = 1e8
 
     def train_stage1(self):
+        # the stage 1 loss leaves out the clean output, RefUNet gets no gradient: frozen so that
+        # DDP does not wait for its gradients (it is trained in stage 2)
+        self.trainable(distributed.unwrap_model(self.G).ref, False)
+        self.wrap_distributed()
+        self.stage1_step = self.build_stage1_step()
         for epoch in range(1, self.epoch_limit + 1):
             print("Epoch: %d: " % epoch)
             self.epoch = epoch
+            distributed.set_epoch(self.data, epoch)
             self.train_one_epoch_stage1()
+            # validation previews of the test_input_dir sample, see evaluator.py
             self.validate()
-            self.predict_resize(repr(epoch))
-            state = {'epoch': self.epoch, 'G': self.G.state_dict(),
+            # checkpoints hold the bare model (no 'module.' prefix), only rank 0 writes them
+            state = {'epoch': self.epoch, 'G': distributed.unwrap_model(self.G).state_dict(),
                      'best_valid_acc': self.best_valid_acc, 'lr': self.LR}
-            self.save_checkpoint(state, 'last', False)
-            if epoch % 2 == 0:
-                self.save_checkpoint(state, '-' + str(epoch), False)
+            # one file per epoch, 'last' / 'best' are links to it and checkpoint: keep_last / keep_every prune it
+            self.save_checkpoint(state, '-' + str(epoch), self.is_best)
             if epoch % 10 == 0:
                 self.LR = self.LR / 2
                 self.G_optim = torch.optim.Adam(self.G.parameters(), lr=self.LR)
+        self.finish_validation()
+        # the last metrics window and the queued previews / checkpoints reach the disk
+        self.metrics.flush()
+        self.preview.flush()
+        self.checkpoints.flush()
 
     def train_stage2(self):
         print("Using GPU: #", self.gpuid)
         self.load_checkpoint(self.pretrained_weights, self.parallel, best=False, load_lr=False)
-        self.G.cuda(self.gpuid)
+        self.G.to(self.device)
         self.G_optim = torch.optim.Adam(self.G.parameters(), lr=self.LR)
         self.set_gradients(False)
+        # DDP only synchronizes the parameters that are trainable at this point
+        self.wrap_distributed()
         init_epoch = self.epoch
-        self.predict_resize(repr(0))
+        if distributed.is_main_process():
+            self.predict_resize(repr(0))
         for epoch in range(init_epoch, self.epoch_limit + 1):
             print("Epoch: %d: " % epoch)
-            # reset discriminator
+            # reset discriminator, every process starts from the weights of rank 0
             self.D.apply(self.init_weights)
+            distributed.broadcast_parameters(self.D)
             self.epoch = epoch
             self.train_one_epoch_stage2()
+            # validation previews of the test_input_dir sample, see evaluator.py
             self.validate()
-            self.predict_resize(repr(epoch))
-            state = {'epoch': self.epoch, 'G': self.G.state_dict(), 'D': self.D.state_dict(),
+            state = {'epoch': self.epoch, 'G': distributed.unwrap_model(self.G).state_dict(),
+                     'D': distributed.unwrap_model(self.D).state_dict(),
                      'best_valid_acc': self.best_valid_acc, 'lr': self.LR}
-            self.save_checkpoint(state, 'last', False)
-            if epoch % 2 == 0:
-                self.save_checkpoint(state, '-' + str(epoch), False)
+            # one file per epoch, 'last' / 'best' are links to it and checkpoint: keep_last / keep_every prune it
+            self.save_checkpoint(state, '-' + str(epoch), self.is_best)
             if epoch % 10 == 0:
                 self.set_gradients(True)
                 self.trainable(self.D, True)
@@ -75,248 +99,359 @@ class HaruTrainer():
                 self.D_optim = torch.optim.Adam(self.D.parameters(), lr=self.LR, betas=(0.5, 0.999))
                 self.G_optim = torch.optim.Adam(self.G.parameters(), lr=self.LR * 0.1, betas=(0.5, 0.999))
                 self.set_gradients(False)
+        self.finish_validation()
+        # the last metrics window and the queued previews / checkpoints reach the disk
+        self.metrics.flush()
+        self.preview.flush()
+        self.checkpoints.flush()
 
     def train_one_epoch_stage1(self):
-        epoch_loss = 0
+        # a tensor even if this rank gets no batch, all_reduce needs one on every process
+        epoch_loss = torch.zeros((), device=self.device)
         tic = time.time()
-        # log losses
-        losses = AverageMeter()
-        trans_losses = AverageMeter()
-        atm_losses = AverageMeter()
-        streak_losses = AverageMeter()
-        accs = AverageMeter()
-        atmval = AverageMeter()
-        gr_losses = AverageMeter()
-        clean_losses = AverageMeter()
+        accs = BatchMetrics()
+        prof = self.profiler
+        prof.begin_epoch()
 
         # dataloader = self.load_data('train', aug=False)
         train_sample_len = len(self.data)
-        with tqdm(total=len(self.data) * self.batch_size) as pbar:
+        self.G_optim.zero_grad()
+        with tqdm(total=len(self.data) * self.batch_size, disable=not distributed.is_main_process()) as pbar:
             for i, self.input_list in enumerate(self.data):
-                # input_list: rain, st_sp, st_md, st_ds, im_sp, im_md, im_ds, mask(3 channel)
-                image_in_var = Variable(self.input_list[0]).cuda(self.gpuid)
-                streak_gt_var = Variable(self.input_list[1]).cuda(self.gpuid)
-                trans_gt_var = Variable(self.input_list[2]).cuda(self.gpuid)
-                atm_gt_var = Variable(self.input_list[3]).cuda(self.gpuid)
-                clean_gt_var = Variable(self.input_list[4]).cuda(self.gpuid)
-
-                # forward
-                # NOTE : self.st_out to be added
-                self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(image_in_var)
-
-                # compute loss
-                loss_sp = self.criterionMSE(self.st_out, streak_gt_var)
-                loss_tr = self.criterionMSE(self.trans_out, trans_gt_var)
-                loss_atm = self.criterionMSE(self.atm_out, atm_gt_var)
-                loss_clean = self.criterionMSE(self.clean_out, clean_gt_var)
-                loss_pc = self.criterionMSE(self.vgg(self.clean_out, 3), self.vgg(clean_gt_var, 3))
-                gradient_h_est, gradient_v_est = gradient(self.trans_out)
-                gradient_h_gt, gradient_v_gt = gradient(trans_gt_var)
-                loss_trans_gradient_h = self.criterionL1(gradient_h_est, gradient_h_gt)
-                loss_trans_gradient_v = self.criterionL1(gradient_v_est, gradient_v_gt)
-                loss_gradient = loss_trans_gradient_h + loss_trans_gradient_v
-
-                self.total_loss = loss_sp + loss_tr + loss_atm + 0.5 * loss_gradient
-                epoch_loss += self.total_loss.item()
-                losses.update(self.total_loss.item(), self.batch_size)
-                atmval.update(torch.mean(self.atm_out), self.batch_size)
-                atm_losses.update(loss_atm.item(), self.batch_size)
-                trans_losses.update(loss_tr.item(), self.batch_size)
-                streak_losses.update(loss_sp.item(), self.batch_size)
-                clean_losses.update(loss_clean.item(), self.batch_size)
-                gr_losses.update(loss_pc.item(), self.batch_size)
-
-                # backward
-                self.G_optim.zero_grad()
-                self.total_loss.backward()
-                self.G_optim.step()
-
-                # logging
-                toc = time.time()
-                pbar.set_description(
-                    (
-                        "{:.1f}s L:{:.4f} sp:{:.4f} tr:{:.4f} atm:{:.4f} im:{:.4f} gr:{:.4f} LR:{:.6f} acc:{:.2f} )".format(
-                            (toc - tic),
-                            self.total_loss.item(),
-                            loss_sp.item(),
-                            loss_tr.item(),
-                            loss_atm.item(),
-                            loss_clean.item(),
-                            loss_gradient.item(),
-                            self.LR, accs.avg)
-                    )
-                )
-                pbar.update(self.batch_size)
+                prof.data_ready((self.epoch - 1) * train_sample_len + i)
+                with prof.scope('h2d'):
+                    if self.batch_augment is not None and self.batch_augment.on_device:
+                        self.input_list = self.batch_augment([t.to(self.device) for t in self.input_list],
+                                                             self.data.dataset.aug)
+                    # input_list: rain, st_sp, st_md, st_ds, im_sp, im_md, im_ds, mask(3 channel)
+                    image_in_var = self.to_device(self.input_list[0])
+                    streak_gt_var = self.to_device(self.input_list[1])
+                    trans_gt_var = self.to_device(self.input_list[2])
+                    atm_gt_var = self.to_device(self.input_list[3])
+                    clean_gt_var = self.to_device(self.input_list[4])
+                n = image_in_var.size(0)
+                # optimizer step every accumulation_steps micro-batches, DDP all-reduces the gradients only then
+                step = self.accumulation_boundary(i, train_sample_len)
+                if self.compile_benchmark:
+                    self.compile_speedup(self.stage1_step, self.compile_benchmark,
+                                         (image_in_var, streak_gt_var, trans_gt_var, atm_gt_var, clean_gt_var))
+                    self.compile_benchmark = 0
+
+                # forward and loss, one compiled graph with train: compile (timed as a whole then)
+                step_scope = prof.scope('compiled_step') if self.stage1_compiled else contextlib.nullcontext()
+                with distributed.no_sync(self.G, not step), step_scope:
+                    outputs, self.total_loss, losses = self.stage1_step(
+                        image_in_var, streak_gt_var, trans_gt_var, atm_gt_var, clean_gt_var)
+                self.st_out, self.trans_out, self.atm_out, self.clean_out = outputs
+                loss_sp, loss_tr, loss_atm, loss_clean, loss_pc, loss_gradient = losses
+                epoch_loss += self.total_loss.detach()
+
+                # backward, optimizer step every accumulation_steps micro-batches
+                with prof.scope('backward'):
+                    self.scaler.scale(self.total_loss / self.accumulation_steps).backward()
+                    if step:
+                        self.scaler.step(self.G_optim)
+                        self.scaler.update()
+                        self.G_optim.zero_grad()
 
                 # == Evaluation Region == #
-                recons = (image_in_var - (1 - self.trans_out) * self.atm_out) / (self.trans_out + 0.0001) - self.st_out
-                mini_acc = compute_psnr(recons, clean_gt_var)
-                accs.update(mini_acc, self.batch_size)
+                with prof.scope('psnr'):
+                    recons = (image_in_var - (1 - self.trans_out) * self.atm_out) / (self.trans_out + 0.0001) - self.st_out
+                    mini_acc = accs.update(recons, clean_gt_var)
 
                 # write output
-                if i % 10 == 0:
-                    self.write_image_stage1('./out.jpg')
-
-                if self.use_tensorboard:
-                    iteration = (self.epoch - 1) * train_sample_len + i
-                    log_value('train_loss', losses.avg, iteration)
-                    log_value('train_acc', accs.avg, iteration)
-                    log_value('atm_loss', atm_losses.avg, iteration)
-                    log_value('trans_loss', trans_losses.avg, iteration)
-                    log_value('streak_loss', streak_losses.avg, iteration)
-                    log_value('atm_value', atmval.avg, iteration)
-                    log_value('clean_loss', clean_losses.avg, iteration)
-                    log_value('gr_loss', gr_losses.avg, iteration)
-
-            print("Total Loss: %f" % epoch_loss)
+                if self.preview.due(i):
+                    with prof.scope('preview'):
+                        self.write_image_stage1('./out.jpg')
+
+                # logging: scalars stay on the device, self.metrics writes window means every log: interval steps
+                iteration = (self.epoch - 1) * train_sample_len + i
+                with prof.scope('log'):
+                    if self.metrics.update(iteration,
+                                           train_loss=self.total_loss, train_acc=mini_acc.mean(),
+                                           atm_loss=loss_atm, trans_loss=loss_tr, streak_loss=loss_sp,
+                                           atm_value=torch.mean(self.atm_out), clean_loss=loss_clean,
+                                           gr_loss=loss_pc, gradient_loss=loss_gradient):
+                        pbar.set_description("{:.1f}s {} LR:{:.6f}".format(
+                            time.time() - tic, self.metrics.describe(self.STAGE1_FIELDS), self.LR))
+                pbar.update(n)
+                prof.step(iteration, n)
+
+            print("Total Loss: %f PSNR: %.2f" % (float(distributed.all_reduce(epoch_loss)), accs.sync().get('psnr', 0)))
+            prof.report('Stage 1 epoch %d' % self.epoch)
 
     def train_one_epoch_stage2(self):
-        epoch_loss = 0
+        # a tensor even if this rank gets no batch, all_reduce needs one on every process
+        epoch_loss = torch.zeros((), device=self.device)
         tic = time.time()
-        toc = tic
-        imloss = AverageMeter()
-        pcloss = AverageMeter()
-        genloss = AverageMeter()
-        disloss = AverageMeter()
-        Dtrueloss = AverageMeter()
-        Dfakeloss = AverageMeter()
-        Gadvloss = AverageMeter()
-        Gadvlossrain = AverageMeter()
+        self.accs = BatchMetrics()
+        prof = self.profiler
         dataloader = self.load_data('train', aug=False)
         self.train_sample_len = len(dataloader)
-        with tqdm(total=len(dataloader) * self.batch_size) as pbar:
+        prof.begin_epoch()
+        self.D.zero_grad()
+        self.G.zero_grad()
+        # real rain steps are drawn with a seed of rank 0, every process takes the same branch
+        toggler = np.random.RandomState(distributed.broadcast_object(np.random.randint(2 ** 31)))
+        with tqdm(total=len(dataloader) * self.batch_size, disable=not distributed.is_main_process()) as pbar:
             for i, self.input_list in enumerate(dataloader):
-                if np.random.rand() <= 0.1:
-                    self.real_synt_toggler = 1  # for real rain images
-                else:
-                    self.real_synt_toggler = 0  # for synthetic rain images
-
-                # input_list: rain, st_sp, st_md, st_ds, im_sp, im_md, im_ds, mask(3 channel)
-                self.image_in_var = Variable(self.input_list[0]).cuda(self.gpuid)
-                self.streak_gt_var = Variable(self.input_list[1]).cuda(self.gpuid)
-                self.trans_gt_var = Variable(self.input_list[2]).cuda(self.gpuid)
-                self.atm_gt_var = Variable(self.input_list[3]).cuda(self.gpuid)
-                self.clean_gt_var = Variable(self.input_list[4]).cuda(self.gpuid)
-                self.realrain_gt_var = Variable(self.input_list[5]).cuda(self.gpuid)
+                prof.data_ready((self.epoch - 1) * self.train_sample_len + i)
+                with prof.scope('h2d'):
+                    if self.batch_augment is not None and self.batch_augment.on_device:
+                        self.input_list = self.batch_augment([t.to(self.device) for t in self.input_list],
+                                                             dataloader.dataset.aug)
+                    if toggler.rand() <= 0.1:
+                        self.real_synt_toggler = 1  # for real rain images
+                    else:
+                        self.real_synt_toggler = 0  # for synthetic rain images
+
+                    # input_list: rain, st_sp, st_md, st_ds, im_sp, im_md, im_ds, mask(3 channel)
+                    self.image_in_var = self.to_device(self.input_list[0])
+                    self.streak_gt_var = self.to_device(self.input_list[1])
+                    self.trans_gt_var = self.to_device(self.input_list[2])
+                    self.atm_gt_var = self.to_device(self.input_list[3])
+                    self.clean_gt_var = self.to_device(self.input_list[4])
+                    self.realrain_gt_var = self.to_device(self.input_list[5])
+                n = self.image_in_var.size(0)
+                # optimizer steps every accumulation_steps micro-batches and at the end of the epoch
+                step = self.accumulation_boundary(i, self.train_sample_len)
+
+                # one generator forward per step, shared by the discriminator and the generator update.
+                # The BatchNorm layers of atmnet (the only normalisation of G) see the synthetic batch
+                # once per step, their running statistics follow it over twice as many steps as with
+                # the former forward in both train_dis and train_gen
+                with distributed.no_sync(self.G, not step):
+                    self.forward_gen()
 
                 # DISCRIMINATOR
-                self.trainable(self.D, True)
-                self.D.zero_grad()
-                self.train_dis()  # real error and fake error backward() together
-                self.D_optim.step()
-                self.trainable(self.D, False)
+                with prof.scope('train_dis'):
+                    self.trainable(self.D, True)
+                    with distributed.no_sync(self.D, not step):
+                        self.train_dis()  # real error and fake error backward() together
+                    if step:
+                        self.scaler.step(self.D_optim)
+                        self.D.zero_grad()
+                    self.trainable(self.D, False)
 
                 # GENERATOR
-                self.G.zero_grad()
-                self.train_gen()
-                self.G_optim.step()
-
-                # write output
-                if i % 10 == 0:
-                    self.write_image_stage2('./out.jpg')
+                with prof.scope('train_gen'):
+                    self.train_gen()
+                    if step:
+                        self.scaler.step(self.G_optim)
+                        # one scale update per optimizer step for both optimizers
+                        self.scaler.update()
+                        self.G.zero_grad()
+
+                # write output, rank 0 only: the real rain forward of the preview is not run by the others
+                if distributed.is_main_process() and self.preview.due(i):
+                    with prof.scope('preview'):
+                        if self.realrain_out is None:
+                            self.forward_realrain()
+                        self.write_image_stage2('./out.jpg')
 
                 # LOG LOSS
-                pbar.set_description(
-                    (
-                        "{:.1f}s L:{:.4f} im:{:.4f} adv:{:.4f} gr:{:.4f} pc:{:4f} rain:{:4f} tl:{:4f} fl:{:4f} prb:{:.3f} LR:{:.6f} acc:{:.2f} )".format(
-                            (toc - tic),
-                            self.total_loss.item(),
-                            self.loss_clean.item(),
-                            self.loss_adv.item(),
-                            self.loss_gradient.item(),
-                            self.loss_pc.item(),
-                            self.loss_adv_realrain.item(),
-                            self.tl.item(), self.fl.item(),
-                            self.probability.item(),
-                            self.LR, self.accs.avg)
-                    )
-                )
-                pbar.update(self.batch_size)
-                epoch_loss += self.total_loss.item()
-                imloss.update(self.loss_clean.item(), self.batch_size)
-                pcloss.update(self.loss_pc.item(), self.batch_size)
-                genloss.update(self.total_loss.item(), self.batch_size)
-                disloss.update(self.probability.item(), self.batch_size)
-                Dtrueloss.update(self.tl.item(), self.batch_size)
-                Dfakeloss.update(self.fl.item(), self.batch_size)
-                Gadvloss.update(self.loss_adv.item(), self.batch_size)
-                Gadvlossrain.update(self.loss_adv_realrain.item(), self.batch_size)
-
-                # logging
-                toc = time.time()
-                if self.use_tensorboard:
-                    iteration = (self.epoch - 1) * self.train_sample_len / self.batch_size + i
-                    log_value('dis_loss', disloss.avg, iteration)
-                    log_value('gen_loss', genloss.avg, iteration)
-                    log_value('acc', self.accs.avg, iteration)
-                    log_value('D_true_loss', Dtrueloss.avg, iteration)
-                    log_value('D_fake_loss', Dfakeloss.avg, iteration)
-                    log_value('G_adv_loss', Gadvloss.avg, iteration)
-                    log_value('G_adv_realrain_loss', Gadvlossrain.avg, iteration)
-
-            print("Total Loss: %f" % epoch_loss)
+                epoch_loss += self.total_loss.detach()
+                iteration = (self.epoch - 1) * self.train_sample_len + i
+                with prof.scope('log'):
+                    if self.metrics.update(iteration,
+                                           gen_loss=self.total_loss, dis_loss=self.probability,
+                                           acc=self.mini_acc.mean(), clean_loss=self.loss_clean,
+                                           pc_loss=self.loss_pc, gradient_loss=self.loss_gradient,
+                                           D_true_loss=self.tl, D_fake_loss=self.fl, G_adv_loss=self.loss_adv,
+                                           G_adv_realrain_loss=self.loss_adv_realrain):
+                        pbar.set_description("{:.1f}s {} LR:{:.6f}".format(
+                            time.time() - tic, self.metrics.describe(self.STAGE2_FIELDS), self.LR))
+                pbar.update(n)
+                prof.step(iteration, n)
+
+            print("Total Loss: %f PSNR: %.2f" % (float(distributed.all_reduce(epoch_loss)),
+                                                 self.accs.sync().get('psnr', 0)))
+            prof.report('Stage 2 epoch %d' % self.epoch)
+
+    def stage1_forward(self, image_in_var, streak_gt_var, trans_gt_var, atm_gt_var, clean_gt_var):
+        """
+        Stage 1 forward and losses, see build_stage1_step
+        :return: (streak, trans, atm, clean), total loss,
+                 (streak, trans, atm, clean, perceptual, gradient) losses
+        """
+        prof = self.profiler
+        with utility.autocast(self.device, self.precision):
+            # forward
+            # NOTE : self.st_out to be added
+            with prof.scope('forward'):
+                st_out, trans_out, atm_out, clean_out = self.G(image_in_var)
+
+            # compute loss
+            with prof.scope('loss'):
+                loss_sp = self.criterionMSE(st_out, streak_gt_var)
+                loss_tr = self.criterionMSE(trans_out, trans_gt_var)
+                loss_atm = self.criterionMSE(atm_out, atm_gt_var)
+                loss_clean = self.criterionMSE(clean_out, clean_gt_var)
+                with prof.scope('vgg'):
+                    loss_pc = self.perceptual_loss(clean_out, clean_gt_var)
+                gradient_h_est, gradient_v_est = gradient(trans_out)
+                gradient_h_gt, gradient_v_gt = gradient(trans_gt_var)
+                loss_trans_gradient_h = self.criterionL1(gradient_h_est, gradient_h_gt)
+                loss_trans_gradient_v = self.criterionL1(gradient_v_est, gradient_v_gt)
+                loss_gradient = loss_trans_gradient_h + loss_trans_gradient_v
+
+                total_loss = loss_sp + loss_tr + loss_atm + 0.5 * loss_gradient
+        return (st_out, trans_out, atm_out, clean_out), total_loss, \
+            (loss_sp, loss_tr, loss_atm, loss_clean, loss_pc, loss_gradient)
+
+    def build_stage1_step(self):
+        """
+        stage1_forward, or its torch.compile version with train: compile: enabled.
+        The inductor artefacts go to compile: cache_dir and are reused by later runs;
+        compile: benchmark_steps > 0 prints the speedup over eager on the first batch.
+        """
+        cfg = getattr(self, 'compile_cfg', None) or {}
+        self.stage1_compiled = bool(cfg.get('enabled'))
+        # run by train_one_epoch_stage1 on its first batch
+        self.compile_benchmark = 0
+        if not self.stage1_compiled:
+            return self.stage1_forward
+        if cfg.get('cache_dir'):
+            os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.abspath(cfg['cache_dir'])
+        step = torch.compile(self.stage1_forward, mode=cfg.get('mode') or 'default', dynamic=False)
+        self.compile_benchmark = cfg.get('benchmark_steps') or 0
+        return step
+
+    def compile_speedup(self, compiled, steps, inputs):
+        # forward + loss + backward of eager and compiled stage 1 on the batch inputs. The training
+        # state is left as it was: the gradients are discarded, the BatchNorm running statistics
+        # (atmnet) restored, and under DDP the backward passes skip the gradient all-reduce
+        # always synchronize, the profiler only does with profile: sync
+        def synchronize():
+            if self.device.type == 'cuda':
+                torch.cuda.synchronize(self.device)
+
+        buffers = {name: b.clone() for name, b in distributed.unwrap_model(self.G).named_buffers()}
+        times = {}
+        with distributed.no_sync(self.G):
+            for name, fn in (('eager', self.stage1_forward), ('compiled', compiled)):
+                synchronize()
+                tic = time.time()
+                fn(*inputs)[1].backward()
+                synchronize()
+                first = time.time() - tic
+                tic = time.time()
+                for _ in range(steps):
+                    fn(*inputs)[1].backward()
+                synchronize()
+                times[name] = (time.time() - tic) / steps
+                print('[*] {} stage 1 step: first call {:.1f}s, {:.1f} ms per step'.format(
+                    name, first, times[name] * 1000))
+        with torch.no_grad():
+            for name, b in distributed.unwrap_model(self.G).named_buffers():
+                b.copy_(buffers[name])
+        self.G_optim.zero_grad()
+        print('[*] torch.compile speedup: {:.2f}x'.format(times['eager'] / max(times['compiled'], 1e-9)))
+
+    def forward_gen(self):
+        with utility.autocast(self.device, self.precision):
+            with self.profiler.scope('gen_forward'):
+                self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(self.image_in_var)
+
+    def forward_realrain(self):
+        # D only sees the detached real rain output, so the branch needs no graph; the bare G
+        # keeps the forward out of the DDP buffer broadcast, the preview runs it on rank 0 only
+        G = distributed.unwrap_model(self.G)
+        with torch.no_grad(), utility.autocast(self.device, self.precision):
+            with self.profiler.scope('gen_realrain'):
+                self.realrain_st, self.realrain_trans, self.realrain_atm, self.realrain_out = \
+                    G(self.realrain_gt_var)
+
+    def update_realrain_atm(self):
+        # the atmnet BatchNorm statistics see the real rain batch on every step, also without the
+        # real rain forward: the A branch alone (guided filter and atmnet) on it, like FogNet.forward
+        G = distributed.unwrap_model(self.G)
+        with torch.no_grad(), utility.autocast(self.device, self.precision):
+            with self.profiler.scope('gen_realrain'):
+                lf, _ = G.decomposition(self.realrain_gt_var)
+                G.fognet.estimate_atm(torch.cat([self.realrain_gt_var, lf], dim=1)[:, :, :256, :256])
 
     def train_dis(self):
-        self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(self.image_in_var)
-        # i. real data input:clean ground truth. ii. fake data input: output of generator  G(image_in_var)
-        # 1. Train D on real data
-        depth_gt_real = Variable(torch.zeros(self.batch_size, 1, self.image_size, self.image_size)).cuda(self.gpuid)
-        d_realdata_input = torch.cat((self.image_in_var, self.clean_gt_var), dim=1)
-        depth_real, d_realdata_output = self.D(d_realdata_input)  # result should be True (1)
-        # depth_real = depth_real.repeat(1,3,1,1)
-        d_realdata_error = self.criterionGAN(d_realdata_output, True).cuda(self.gpuid)
-        d_realdepth_error = self.criterionMSE(depth_real, depth_gt_real)
-        total_loss = d_realdata_error + d_realdepth_error
-
-        # 2. Train D on fake data
-
-        d_fakedata_input = torch.cat((self.image_in_var, self.clean_out), dim=1)
-        depth_fake, d_fakedata_output = self.D(d_fakedata_input.detach())
-        d_fakedata_error = self.criterionGAN(d_fakedata_output, False)
-        depth_fake = depth_fake.repeat(1, 3, 1, 1)
-        d_fakedepth_error = self.criterionMSE(depth_fake, 1 - self.trans_out.detach())
-        total_loss += d_fakedata_error + d_fakedepth_error
-        total_loss.backward()
+        # uses the generator output of forward_gen, detached
+        with utility.autocast(self.device, self.precision):
+            # i. real data input:clean ground truth. ii. fake data input: output of generator  G(image_in_var)
+            # 1. Train D on real data
+            d_realdata_input = torch.cat((self.image_in_var, self.clean_gt_var), dim=1)
+            depth_real, d_realdata_output = self.D(d_realdata_input)  # result should be True (1)
+            # any batch size: the depth target follows the discriminator output
+            depth_gt_real = torch.zeros_like(depth_real)
+            # depth_real = depth_real.repeat(1,3,1,1)
+            d_realdata_error = self.criterionGAN(d_realdata_output, True).to(self.device)
+            d_realdepth_error = self.criterionMSE(depth_real, depth_gt_real)
+            total_loss = d_realdata_error + d_realdepth_error
+
+            # 2. Train D on fake data
+
+            d_fakedata_input = torch.cat((self.image_in_var, self.clean_out), dim=1)
+            depth_fake, d_fakedata_output = self.D(d_fakedata_input.detach())
+            d_fakedata_error = self.criterionGAN(d_fakedata_output, False)
+            depth_fake = depth_fake.repeat(1, 3, 1, 1)
+            d_fakedepth_error = self.criterionMSE(depth_fake, 1 - self.trans_out.detach())
+            total_loss += d_fakedata_error + d_fakedepth_error
+        self.scaler.scale(total_loss / self.accumulation_steps).backward()
 
         self.probability = (d_realdata_error + d_fakedata_error).mean()
         self.fl = d_fakedata_error
         self.tl = d_realdata_error
 
     def train_gen(self):
-        # Feed Forward
-        self.st_out, self.trans_out, self.atm_out, self.clean_out = self.G(self.image_in_var)
-        D_input = torch.cat((self.image_in_var, self.clean_out), dim=1)
-        depth_mask, self.dis_out = self.D(D_input.detach())
-
-        # compute loss
-        self.loss_clean = self.criterionMSE(self.clean_out, self.clean_gt_var)
-        self.loss_adv = self.criterionGAN(self.dis_out, True)
-
-        # get gradients
-        gradient_h_est, gradient_v_est = gradient(self.clean_out)
-        gradient_h_gt, gradient_v_gt = gradient(self.clean_gt_var)
-        loss_trans_gradient_h = self.criterionL1(gradient_h_est, gradient_h_gt)
-        loss_trans_gradient_v = self.criterionL1(gradient_v_est, gradient_v_gt)
-        self.loss_gradient = loss_trans_gradient_h + loss_trans_gradient_v
-        self.loss_pc = self.criterionMSE(self.vgg(self.clean_out, 8), self.vgg(self.clean_gt_var, 8))
-        self.realrain_st, self.realrain_trans, self.realrain_atm, self.realrain_out = self.G(self.realrain_gt_var)
-
-        # sum loss
-        if self.real_synt_toggler == 1:
-            # print("Real Rain!")
-            realrain_D_input = torch.cat((self.realrain_gt_var, self.realrain_out), dim=1)
-            depth_mask, self.dis_realrain_out = self.D(realrain_D_input.detach())
-            self.loss_adv_realrain = self.criterionGAN(self.dis_realrain_out, True)
-            self.total_loss = self.loss_clean + 0.01 * self.loss_adv + 2 * self.loss_pc + self.loss_gradient + 0.01 * self.loss_adv_realrain
-        else:
-            self.total_loss = self.loss_clean + 0.01 * self.loss_adv + 2 * self.loss_pc + self.loss_gradient
+        # Feed Forward: the generator output of forward_gen
+        # D is frozen here, its bare module keeps DDP from waiting for D gradients
+        D = distributed.unwrap_model(self.D)
+        with utility.autocast(self.device, self.precision):
+            D_input = torch.cat((self.image_in_var, self.clean_out), dim=1)
+            depth_mask, self.dis_out = D(D_input.detach())
+
+            # compute loss
+            self.loss_clean = self.criterionMSE(self.clean_out, self.clean_gt_var)
+            self.loss_adv = self.criterionGAN(self.dis_out, True)
+
+            # get gradients
+            gradient_h_est, gradient_v_est = gradient(self.clean_out)
+            gradient_h_gt, gradient_v_gt = gradient(self.clean_gt_var)
+            loss_trans_gradient_h = self.criterionL1(gradient_h_est, gradient_h_gt)
+            loss_trans_gradient_v = self.criterionL1(gradient_v_est, gradient_v_gt)
+            self.loss_gradient = loss_trans_gradient_h + loss_trans_gradient_v
+            with self.profiler.scope('vgg'):
+                self.loss_pc = self.perceptual_loss(self.clean_out, self.clean_gt_var)
+
+            # sum loss
+            if self.real_synt_toggler == 1:
+                # print("Real Rain!")
+                self.forward_realrain()
+                realrain_D_input = torch.cat((self.realrain_gt_var, self.realrain_out), dim=1)
+                depth_mask, self.dis_realrain_out = D(realrain_D_input.detach())
+                self.loss_adv_realrain = self.criterionGAN(self.dis_realrain_out, True)
+                self.total_loss = self.loss_clean + 0.01 * self.loss_adv + 2 * self.loss_pc + self.loss_gradient + 0.01 * self.loss_adv_realrain
+            else:
+                self.realrain_out = None
+                self.update_realrain_atm()
+                self.loss_adv_realrain = torch.zeros((), device=self.device)
+                self.total_loss = self.loss_clean + 0.01 * self.loss_adv + 2 * self.loss_pc + self.loss_gradient
 
         # backward
-        self.total_loss.backward()
+        with self.profiler.scope('gen_backward'):
+            self.scaler.scale(self.total_loss / self.accumulation_steps).backward()
 
         # # == Evaluation Region == #
-        mini_acc = compute_psnr(self.clean_out, self.clean_gt_var)
-        self.accs.update(mini_acc, self.batch_size)
+        with self.profiler.scope('psnr'):
+            self.mini_acc = self.accs.update(self.clean_out, self.clean_gt_var)
+
+    def accumulation_boundary(self, i, num_batches):
+        # True after every accumulation_steps micro-batches and for the last batch of the epoch
+        return (i + 1) % self.accumulation_steps == 0 or i + 1 == num_batches
+
+    def to_device(self, tensor):
+        # host-to-device copy of a batch, channels_last when train: channels_last is set
+        tensor = tensor.to(self.device, non_blocking=True)
+        if self.channels_last:
+            tensor = tensor.contiguous(memory_format=torch.channels_last)
+        return tensor
 
     def test(self):
         torch.set_grad_enabled(False)
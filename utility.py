@@ -1,7 +1,16 @@
 import os
+import re
 import math
 import time
 import datetime
+import csv
+import json
+import shutil
+import atexit
+import contextlib
+import queue
+import threading
+from collections import OrderedDict
 from multiprocessing import Process
 from multiprocessing import Queue
 
@@ -12,11 +21,14 @@ import matplotlib.pyplot as plt
 
 import numpy as np
 import imageio
+from PIL import Image
 
 import torch
 import torch.optim as optim
 import torch.optim.lr_scheduler as lrs
 
+import distributed
+
 
 class timer():
     def __init__(self):
@@ -44,6 +56,595 @@ class timer():
         self.acc = 0
 
 
+def autocast(device, precision):
+    """
+    autocast context of the precision mode in application.yml (train: precision)
+    :param device: training device, autocast runs on its type ('cpu' or 'cuda')
+    :param precision: 'fp32' (autocast off), 'bf16' or 'fp16'
+    """
+    dtype = {'bf16': torch.bfloat16, 'fp16': torch.float16}.get(precision)
+    if dtype is None:
+        return contextlib.nullcontext()
+    return torch.autocast(torch.device(device).type, dtype=dtype)
+
+
+def make_grad_scaler(device, precision):
+    # only fp16 needs loss scaling, bf16 has the exponent range of fp32
+    return torch.amp.GradScaler(torch.device(device).type, enabled=precision == 'fp16')
+
+
+def async_to_host(tensor):
+    """
+    Start a non-blocking copy of a device tensor into pinned host memory
+    :return: (host tensor, CUDA event to synchronize on before reading it, or None)
+    """
+    if not tensor.is_cuda:
+        return tensor, None
+    host = torch.empty(tensor.size(), dtype=tensor.dtype, pin_memory=True)
+    host.copy_(tensor, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record()
+    return host, event
+
+
+class PreviewWriter(object):
+    """
+    Background sink for the training preview images (write_image_stage1/2).
+    submit() quantizes the painter to uint8 on its device and starts one
+    non-blocking copy to pinned host memory; PNG/JPEG encoding happens on a
+    writer thread. The queue is bounded: under backpressure new previews are
+    dropped (counted in dropped) unless block is set.
+    """
+
+    def __init__(self, every=10, seconds=0, queue_size=2):
+        """
+        :param every: preview every `every` iterations, 0 to disable
+        :param seconds: also preview when this many seconds passed since the last one, 0 to disable
+        :param queue_size: previews waiting for the writer before new ones are dropped
+        """
+        self.every = every
+        self.seconds = seconds
+        self.queue = queue.Queue(maxsize=max(1, queue_size))
+        self.dropped = 0
+        self.last_time = time.time()
+        self.thread = None
+
+    def due(self, iteration):
+        if self.every and iteration % self.every == 0:
+            return True
+        return bool(self.seconds) and time.time() - self.last_time >= self.seconds
+
+    def submit(self, painter, path, block=False):
+        """
+        :param painter: 1 x C x H x W or C x H x W in [0, 1], on any device
+        :param path: output file, the format follows the extension
+        :param block: wait for room in the queue instead of dropping the preview
+        :return: False if the preview was dropped
+        """
+        if not block and self.queue.full():
+            self.dropped += 1
+            return False
+        self.last_time = time.time()
+        with torch.no_grad():
+            frame = painter.detach()
+            if frame.dim() == 4:
+                frame = frame[0]
+            # same quantization as np.clip(img * 255, 0, 255).astype(np.uint8)
+            frame = (frame.float() * 255).clamp_(0, 255).to(torch.uint8).permute(1, 2, 0)
+            frame, event = async_to_host(frame)
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        try:
+            self.queue.put((path, frame, event), block=block)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+
+    def _run(self):
+        while True:
+            path, frame, event = self.queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                img = frame.numpy()
+                if img.shape[-1] == 1:
+                    img = np.dstack((img, img, img))
+                Image.fromarray(img).save(path)
+            except Exception as e:
+                print('\nFailed to write preview {}: {}'.format(path, e))
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        # wait until every queued preview is on disk
+        self.queue.join()
+
+
+def build_preview_writer(config):
+    """
+    Build the PreviewWriter described by `log:` of application.yml
+    (preview_every, preview_seconds, preview_queue)
+    """
+    cfg = (config or {}).get('log') or {}
+    every = cfg.get('preview_every')
+    return PreviewWriter(every=10 if every is None else every,
+                         seconds=cfg.get('preview_seconds') or 0,
+                         queue_size=cfg.get('preview_queue') or 2)
+
+
+class MetricsLogger(object):
+    """
+    Buffered scalar logger for the training loops.
+    update() adds scalars (detached device tensors or floats) to the sums of
+    the current window without synchronizing. Every `every` steps or `seconds`
+    seconds the window means are stacked into one tensor, copied to the host
+    with one non-blocking copy and written by a background thread to the
+    sinks: 'tensorboard' (tensorboard_logger, configured in Haru.reset),
+    'jsonl' (metrics.jsonl) and 'csv' (metrics.csv) in log_dir.
+    """
+
+    def __init__(self, log_dir=None, sinks=('tensorboard',), every=10, seconds=0):
+        """
+        :param log_dir: directory of the jsonl/csv sinks
+        :param sinks: any of 'tensorboard', 'jsonl', 'csv'
+        :param every: write the window means every `every` steps
+        :param seconds: also write when this many seconds passed since the last write, 0 to disable
+        """
+        self.log_dir = log_dir
+        self.sinks = list(sinks)
+        self.every = every
+        self.seconds = seconds
+        self.sums = OrderedDict()
+        self.counts = {}
+        # window means of the last write, on the host
+        self.latest = {}
+        self.step = None
+        self.last_time = time.time()
+        self.queue = queue.Queue(maxsize=16)
+        self.thread = None
+        self._jsonl = None
+        self._csv = None
+        self._csv_writer = None
+        if self.log_dir and ('jsonl' in self.sinks or 'csv' in self.sinks):
+            os.makedirs(self.log_dir, exist_ok=True)
+
+    def update(self, step, **scalars):
+        """
+        :param step: global step of the values, written with them
+        :return: True when the window was written at this step
+        """
+        self.step = step
+        for name, value in scalars.items():
+            if torch.is_tensor(value):
+                value = value.detach().float()
+            self.sums[name] = value if name not in self.sums else self.sums[name] + value
+            self.counts[name] = self.counts.get(name, 0) + 1
+        if self.due(step):
+            self.emit(step)
+            return True
+        return False
+
+    def due(self, step):
+        if self.every and step % self.every == 0:
+            return True
+        return bool(self.seconds) and time.time() - self.last_time >= self.seconds
+
+    def emit(self, step):
+        # hand the window means to the writer thread and start a new window
+        if not self.sums:
+            return
+        names = list(self.sums)
+        means = [self.sums[name] / self.counts[name] for name in names]
+        device = next((m.device for m in means if torch.is_tensor(m)), torch.device('cpu'))
+        values = torch.stack([torch.as_tensor(m, dtype=torch.float32, device=device).reshape(()) for m in means])
+        host, event = async_to_host(values)
+        self.sums = OrderedDict()
+        self.counts = {}
+        self.last_time = time.time()
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        self.queue.put((step, names, host, event))
+
+    def describe(self, fields):
+        """
+        progress bar text from the last written window, never synchronizes
+        :param fields: (metric name, short name) pairs
+        """
+        latest = self.latest
+        return ' '.join('{}:{:.4f}'.format(short, latest[name]) for name, short in fields if name in latest)
+
+    def _run(self):
+        while True:
+            step, names, host, event = self.queue.get()
+            try:
+                if event is not None:
+                    event.synchronize()
+                values = OrderedDict(zip(names, host.tolist()))
+                self.latest = values
+                self.write(step, values)
+            except Exception as e:
+                print('\nFailed to write metrics of step {}: {}'.format(step, e))
+            finally:
+                self.queue.task_done()
+
+    def write(self, step, values):
+        if 'tensorboard' in self.sinks:
+            from tensorboard_logger import log_value
+            for name, value in values.items():
+                log_value(name, value, step)
+        if 'jsonl' in self.sinks:
+            if self._jsonl is None:
+                self._jsonl = open(os.path.join(self.log_dir, 'metrics.jsonl'), 'a')
+            record = OrderedDict([('step', step), ('time', time.time())])
+            record.update(values)
+            self._jsonl.write(json.dumps(record) + '\n')
+            self._jsonl.flush()
+        if 'csv' in self.sinks:
+            fields = ['step', 'time'] + list(values)
+            if self._csv is None or not set(fields) <= set(self._csv_writer.fieldnames):
+                # a window with new names (e.g. the next stage) starts a file with its own header
+                self.open_csv(fields if self._csv is None else self._csv_writer.fieldnames +
+                              [f for f in fields if f not in self._csv_writer.fieldnames])
+            row = {'step': step, 'time': time.time()}
+            row.update(values)
+            self._csv_writer.writerow(row)
+            self._csv.flush()
+
+    def open_csv(self, fields):
+        """
+        Append to metrics.csv in log_dir if its header is fields, else to the first of
+        metrics-1.csv, metrics-2.csv, ... that is new or has that header; rows are never
+        written under another header
+        """
+        if self._csv is not None:
+            self._csv.close()
+        index = 0
+        while True:
+            path = os.path.join(self.log_dir, 'metrics.csv' if not index else 'metrics-{}.csv'.format(index))
+            if not os.path.exists(path):
+                new_file = True
+                break
+            with open(path, newline='') as f:
+                header = next(csv.reader(f), None)
+            if header == fields:
+                new_file = False
+                break
+            index += 1
+        self._csv = open(path, 'a', newline='')
+        self._csv_writer = csv.DictWriter(self._csv, fields, restval='')
+        if new_file:
+            self._csv_writer.writeheader()
+
+    def flush(self):
+        # write the partial window and wait until every emitted window is written
+        if self.step is not None:
+            self.emit(self.step)
+        self.queue.join()
+
+
+def build_metrics_logger(config, log_dir, tensorboard=False, main_process=True):
+    """
+    Build the MetricsLogger described by `log: metrics:` of application.yml
+    (sinks, every, seconds); every defaults to log: interval
+    :param tensorboard: add the tensorboard sink
+    :param main_process: False for the other ranks of a distributed run, they keep no sinks
+    """
+    log_cfg = (config or {}).get('log') or {}
+    cfg = log_cfg.get('metrics') or {}
+    sinks = list(cfg.get('sinks') or [])
+    if tensorboard and 'tensorboard' not in sinks:
+        sinks.append('tensorboard')
+    if not main_process:
+        sinks = []
+    return MetricsLogger(log_dir=cfg.get('dir') or log_dir,
+                         sinks=sinks,
+                         every=cfg.get('every') or log_cfg.get('interval') or 10,
+                         seconds=cfg.get('seconds') or 0)
+
+
+class StepProfiler(object):
+    """
+    Hot-path timing of the training loops.
+    scope(name) times a phase with utility.timer, synchronizing the device
+    before and after so that asynchronous kernels are charged to their phase;
+    data_ready() charges the wait for the DataLoader since the last step to
+    'data'. Optionally torch.profiler records global steps trace_start up to
+    trace_end and exports a Chrome trace. report() prints mean/p95 per phase
+    and samples/sec, then starts over. Disabled, scope() is a null context.
+    """
+
+    def __init__(self, enabled=False, device='cpu', sync=True, trace_start=None, trace_end=None,
+                 trace_dir='profile'):
+        """
+        :param sync: synchronize the device around every scope (exact per-phase times, slower steps)
+        :param trace_start: first global step of the torch.profiler window, None to disable
+        :param trace_end: last global step of the window (inclusive), None for trace_start alone
+        :param trace_dir: directory of the Chrome trace files
+        """
+        self.enabled = enabled
+        self.device = torch.device(device)
+        self.sync = sync
+        self.trace_start = trace_start
+        self.trace_end = trace_end
+        self.trace_dir = trace_dir
+        self.prof = None
+        self.trace_first = None
+        self.begin_epoch()
+
+    def begin_epoch(self):
+        self.times = OrderedDict()
+        self.samples = 0
+        self.epoch_timer = timer()
+        self.step_timer = timer()
+
+    def synchronize(self):
+        if self.sync and self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
+    def scope(self, name):
+        # inside a torch.compile region the phases are fused, the enclosing scope times them
+        if not self.enabled or torch.compiler.is_compiling():
+            return contextlib.nullcontext()
+        return self._scope(name)
+
+    @contextlib.contextmanager
+    def _scope(self, name):
+        self.synchronize()
+        t = timer()
+        if self.prof is not None:
+            with torch.profiler.record_function(name):
+                yield
+        else:
+            yield
+        self.synchronize()
+        self.times.setdefault(name, []).append(t.toc())
+
+    def trace_last(self):
+        # last global step of the torch.profiler window, a single step without trace_end
+        return self.trace_end if self.trace_end is not None else self.trace_start
+
+    def data_ready(self, step=None):
+        """
+        start of a training step: charges the DataLoader wait since the end of the last step
+        :param step: global step, the torch.profiler window opens here so that it covers the whole step
+        """
+        if not self.enabled:
+            return
+        self.times.setdefault('data', []).append(self.step_timer.toc())
+        # >=: a run resumed inside the window still traces its remaining steps
+        if self.trace_start is not None and self.prof is None and step is not None and \
+                self.trace_start <= step <= self.trace_last():
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.device.type == 'cuda':
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.prof = torch.profiler.profile(activities=activities, record_shapes=True)
+            self.prof.__enter__()
+            self.trace_first = step
+
+    def step(self, step, samples):
+        """
+        end of a training step
+        :param step: global step, the torch.profiler window closes after trace_end
+        :param samples: samples processed in the step
+        """
+        if not self.enabled:
+            return
+        self.samples += samples
+        if self.prof is not None and step >= self.trace_last():
+            self.prof.__exit__(None, None, None)
+            os.makedirs(self.trace_dir, exist_ok=True)
+            path = os.path.join(self.trace_dir, 'trace_{}-{}.json'.format(self.trace_first, step))
+            self.prof.export_chrome_trace(path)
+            print('\n[*] Chrome trace of steps {}-{} written to {}'.format(self.trace_first, step, path))
+            self.prof = None
+            self.trace_start = None
+        self.step_timer.tic()
+
+    def report(self, title='Epoch'):
+        if not self.enabled or not self.times:
+            return
+        elapsed = self.epoch_timer.toc()
+        print('\n[*] {} profile: {} samples in {:.1f}s, {:.2f} samples/sec'.format(
+            title, self.samples, elapsed, self.samples / max(elapsed, 1e-6)))
+        print('{:<16}{:>8}{:>12}{:>12}{:>12}'.format('phase', 'count', 'mean ms', 'p95 ms', 'total s'))
+        for name, values in self.times.items():
+            values = np.array(values)
+            print('{:<16}{:>8}{:>12.2f}{:>12.2f}{:>12.2f}'.format(
+                name, len(values), values.mean() * 1000, np.percentile(values, 95) * 1000, values.sum()))
+        self.begin_epoch()
+
+
+def build_step_profiler(config, device):
+    """
+    Build the StepProfiler described by the `profile:` section of application.yml
+    """
+    cfg = (config or {}).get('profile') or {}
+    return StepProfiler(enabled=bool(cfg.get('enabled')),
+                        device=device,
+                        sync=cfg.get('sync', True),
+                        trace_start=cfg.get('trace_start'),
+                        trace_end=cfg.get('trace_end'),
+                        trace_dir=cfg.get('trace_dir') or 'profile')
+
+
+def cpu_snapshot(obj):
+    """
+    Copy of a checkpoint state (nested dicts / lists of tensors and numbers)
+    with every tensor detached and copied to host memory, so that training
+    can go on updating the parameters while the copy is serialized
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, cpu_snapshot(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(cpu_snapshot(v) for v in obj)
+    return obj
+
+
+class CheckpointWriter(object):
+    """
+    Background checkpoint service.
+    save() snapshots the state to the CPU and returns; a thread serializes it
+    to a temporary file and renames it over <model_name><msg>_ckpt.pth.tar,
+    so a checkpoint on disk is always complete. The aliases
+    <model_name>last_ckpt.pth.tar and <model_name>_model_best.pth.tar are hard
+    links to the latest / best file instead of copies.
+    Retention applies to the epoch files <model_name>-<epoch>_ckpt.pth.tar:
+    the keep_last newest ones and every keep_every-th epoch are kept.
+    """
+
+    def __init__(self, ckpt_dir, model_name, keep_last=0, keep_every=0, background=True):
+        """
+        :param keep_last: number of newest epoch files to keep, 0 keeps all
+        :param keep_every: epochs that are multiples of keep_every are always kept, 0 for none
+        :param background: False writes in the calling thread
+        """
+        self.ckpt_dir = ckpt_dir
+        self.model_name = model_name
+        self.keep_last = keep_last
+        self.keep_every = keep_every
+        self.background = background
+        # one pending checkpoint at most: a second save() waits for the first to reach the disk
+        self.queue = queue.Queue(maxsize=1)
+        self.thread = None
+        self.epoch_file = re.compile(r'^{}-(\d+)_ckpt\.pth\.tar$'.format(re.escape(model_name)))
+
+    def path(self, msg):
+        return os.path.join(self.ckpt_dir, self.model_name + msg + '_ckpt.pth.tar')
+
+    @property
+    def best_path(self):
+        return os.path.join(self.ckpt_dir, self.model_name + '_model_best.pth.tar')
+
+    def save(self, state, msg, is_best=False):
+        """
+        :param state: checkpoint dict, tensors may live on any device
+        :param msg: file name part, 'last' or '-<epoch>'
+        :param is_best: also point the best alias at this checkpoint
+        """
+        job = (cpu_snapshot(state), msg, is_best)
+        if not self.background:
+            self.write(*job)
+            return
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+            atexit.register(self.flush)
+        self.queue.put(job)
+
+    def link_best(self, msg):
+        """
+        Point the best alias at an earlier checkpoint, once its pending write is done
+        (validation results that arrive after the checkpoint of their epoch)
+        """
+        job = (None, msg, True)
+        if not self.background:
+            self.write(*job)
+            return
+        self.queue.put(job)
+
+    def _run(self):
+        while True:
+            job = self.queue.get()
+            try:
+                self.write(*job)
+            except Exception as e:
+                print('\nFailed to write checkpoint {}: {}'.format(self.path(job[1]), e))
+            finally:
+                self.queue.task_done()
+
+    def write(self, state, msg, is_best):
+        """
+        :param state: None to only link the aliases to the existing file of msg
+        """
+        path = self.path(msg)
+        if state is not None:
+            if not os.path.exists(self.ckpt_dir):
+                os.makedirs(self.ckpt_dir)
+            tmp = '{}.{}.tmp'.format(path, os.getpid())
+            with open(tmp, 'wb') as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, path)
+            if msg != 'last':
+                self.link(path, self.path('last'))
+        if is_best:
+            self.link(path, self.best_path)
+        if state is not None:
+            self.apply_retention()
+
+    @staticmethod
+    def link(path, alias):
+        # hard link under a temporary name, then rename over the alias
+        tmp = '{}.{}.tmp'.format(alias, os.getpid())
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        try:
+            os.link(path, tmp)
+        except OSError:
+            # file systems without hard links
+            shutil.copyfile(path, tmp)
+        os.replace(tmp, alias)
+
+    def apply_retention(self):
+        if not self.keep_last:
+            return
+        epochs = []
+        for f in os.listdir(self.ckpt_dir):
+            m = self.epoch_file.match(f)
+            if m:
+                epochs.append(int(m.group(1)))
+        # the aliases are separate links, removing an epoch file never removes last / best
+        for epoch in sorted(epochs)[:-self.keep_last]:
+            if self.keep_every and epoch % self.keep_every == 0:
+                continue
+            os.remove(self.path('-' + str(epoch)))
+
+    def flush(self):
+        # wait until every submitted checkpoint is on disk
+        self.queue.join()
+
+
+def read_checkpoint(path, keys=None, map_location='cpu'):
+    """
+    Read a checkpoint memory-mapped, only the tensors of the requested entries are paged in
+    :param keys: entries to return, e.g. ('G', 'lr', 'epoch'), None for all;
+                 a file holding a bare state dict is read as {'G': state_dict}
+    :param map_location: 'cpu' lets load_state_dict copy straight into the model on its device
+    :return: dict of the entries found, the state dicts (G, D) keyed for the bare model
+    """
+    try:
+        ckpt = torch.load(path, map_location=map_location, mmap=True)
+    except RuntimeError:
+        # files of the legacy (non zip) format can not be memory-mapped
+        ckpt = torch.load(path, map_location=map_location)
+    if 'G' not in ckpt and 'D' not in ckpt:
+        ckpt = {'G': ckpt}
+    out = {}
+    for k in (keys if keys is not None else ckpt.keys()):
+        if k not in ckpt:
+            continue
+        out[k] = distributed.strip_module_prefix(ckpt[k]) if k in ('G', 'D') else ckpt[k]
+    return out
+
+
+def build_checkpoint_writer(config, ckpt_dir, model_name):
+    """
+    Build the CheckpointWriter described by the `checkpoint:` section of application.yml
+    (background, keep_last, keep_every)
+    """
+    cfg = (config or {}).get('checkpoint') or {}
+    return CheckpointWriter(ckpt_dir, model_name,
+                            keep_last=cfg.get('keep_last') or 0,
+                            keep_every=cfg.get('keep_every') or 0,
+                            background=cfg.get('background', True))
+
+
 class checkpoint():
     def __init__(self, args):
         self.args = args